@@ -30,7 +30,7 @@ class MyBot:
     # the ants class is created and setup by the Ants.run method
     def do_setup(self, ants):
         # initialize data structures after learning the game settings
-        pass
+        ants.start_pool()
 
     # do turn is run once per turn
     # the ants class has the game state and is updated by the Ants.run method
@@ -49,7 +49,7 @@ class MyBot:
             'combat': 0,
         }
         total_food = len(ants.food())
-        defense_locations = ants.defense_locations()
+        defense_locations = set(ants.defense_locations())
 
         for ant_loc in ants.my_ants():
             row, col = ant_loc
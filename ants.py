@@ -3,11 +3,22 @@ import sys
 import traceback
 import random
 import time
-from collections import defaultdict
+from array import array
+from collections import defaultdict, deque
 import math
+import threading
+import multiprocessing
+import ctypes
 
 import logging
 
+# numpy lets us diffuse every channel of the whole map at once, but it isn't
+# guaranteed to be installed so fall back to the pure python passes
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logging.basicConfig(
             level=logging.DEBUG,
             format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
@@ -38,6 +49,77 @@ DIFFUSION = {
     'FRIENDLY_ANT': 50
 }
 
+# The potential channels that are diffused every turn
+CHANNELS = ('FOOD', 'EXPLORE', 'COMBAT', 'ALLIED', 'ENEMY')
+
+# FULL re-diffuses the whole map every turn, INCREMENTAL warm starts from
+# last turn's potentials and only re-relaxes around squares that changed,
+# MULTIGRID solves on the coarse region grid before diffusing the squares and
+# BFS skips diffusing and uses the walking distance to the nearest source
+DIFFUSION_MODE = 'FULL'
+
+# How much a potential is multiplied by for every step away from its source
+# in BFS mode. Small enough that nearer targets win, big enough that a
+# potential is still above 0 on the far side of the biggest maps.
+BFS_DECAY = 0.8
+
+# Width and height of the cells in the region map
+REGION_SIZE = 10
+
+# Most passes to spend relaxing the coarse region grid in MULTIGRID mode, it
+# stops early once no region changes by more than COARSE_TOLERANCE of its
+# value. This is relative since the far away potentials we want to reach are
+# tiny, but ants only care which neighbour is bigger.
+COARSE_MAX_PASSES = 500
+COARSE_TOLERANCE = 0.001
+
+# Incremental diffusion only re-relaxes the squares within this many steps
+# of one that changed since last turn, and falls back to a full diffusion
+# when they are more than INCREMENTAL_MAX_DIRTY of the map
+INCREMENTAL_RADIUS = 8
+INCREMENTAL_MAX_DIRTY = 0.25
+
+# Incremental diffusion stops relaxing a square's neighbours once none of its
+# potentials changed by more than this much of the channel's largest fixed
+# potential
+INCREMENTAL_TOLERANCE = 0.001
+
+# Full diffusion stops before the time runs out once every channel's residual
+# (how much it changed in the last pass) is under CONVERGENCE_TOLERANCE times
+# the channel's largest fixed potential. MAX is the biggest change on any one
+# square, L1 the total change over the map and None keeps diffusing until we
+# run out of time. Background diffusion always stops once the channels have
+# converged, by the MAX residual when this is None.
+CONVERGENCE_RESIDUAL = None
+CONVERGENCE_TOLERANCE = 0.00001
+
+# Keep relaxing last turn's potentials in a background thread while we wait
+# for the engine to send the next turn, the next diffuse() then starts from
+# the relaxed potentials
+BACKGROUND_DIFFUSION = False
+
+# Number of processes to split the channels between for full diffusion, the
+# channels never mix so each process diffuses its own block of them until
+# the time runs out. The potentials live in shared memory and the processes
+# are forked once in start_pool(). 0 diffuses in this process.
+DIFFUSION_PROCESSES = 0
+
+# How many milliseconds past the diffusion deadline we wait for a diffusion
+# process to answer before shutting the pool down and diffusing ourselves
+POOL_TIMEOUT = 20
+
+# Width and height of the buckets the spatial index sorts the turn's ants,
+# food and hills into
+BUCKET_SIZE = 8
+
+# How many of the latest diffusion passes the pass cost model remembers, it
+# predicts the next pass will be as slow as the slowest of them so the odd
+# pass slowed down by garbage collection doesn't run us out of time
+PASS_COST_SAMPLES = 200
+
+# How many turns of diffusion telemetry diffusion_stats() returns
+DIFFUSION_HISTORY = 20
+
 # How many ants we should have before performing certain actions
 ANTS_BEFORE_DEFENDING = 5
 ANTS_PER_DEFENDER = 5
@@ -71,6 +153,336 @@ BEHIND = {'n': 's',
           'w': 'e'}
 
 
+class PotentialMap():
+    """ Holds every potential channel for the whole map. Each channel is one
+    contiguous float buffer indexed by row * cols + col, and the channels
+    are laid out one after another in CHANNELS order.
+
+    Reading potential_map[row][col]['FOOD'] still works through thin row and
+    square views, but get() and set() avoid creating the views. """
+
+    def __init__(self, rows, cols, value=0.0):
+        self.rows = rows
+        self.cols = cols
+        self.size = rows * cols
+        self.data = array('f', [value]) * (len(CHANNELS) * self.size)
+        self.offsets = dict((channel, i * self.size)
+                            for i, channel in enumerate(CHANNELS))
+
+    def __getitem__(self, row):
+        return PotentialRow(self, row * self.cols)
+
+    def get(self, channel, row, col):
+        return self.data[self.offsets[channel] + row * self.cols + col]
+
+    def set(self, channel, row, col, value):
+        self.data[self.offsets[channel] + row * self.cols + col] = value
+
+    def sources(self):
+        """ Returns a list of (index, value) for every potential above 0 """
+        return [(index, value) for index, value in enumerate(self.data)
+                if value > 0]
+
+    def as_array(self):
+        """ Returns a (channel, row, col) numpy view sharing our buffer """
+        return numpy.frombuffer(self.data, numpy.float32).reshape(
+            (len(CHANNELS), self.rows, self.cols))
+
+
+class PassCostModel():
+    """ Rolling model of how long a diffusion pass takes on this map. A pass
+    does about the same work for every square of every channel and for every
+    fixed potential written back, so we remember the milliseconds per unit
+    of work of the latest passes and predict with the slowest. """
+
+    def __init__(self):
+        self.rates = deque(maxlen=PASS_COST_SAMPLES)
+        self.rate = None
+
+    @staticmethod
+    def work(cells, channels, sources):
+        return cells * channels + sources
+
+    def record(self, ms, work):
+        self.rates.append(ms / float(work))
+        self.rate = max(self.rates)
+
+    def predict(self, work):
+        """ Returns how many milliseconds a pass doing this much work should
+        take, None until we have timed a pass """
+        if self.rate is None:
+            return None
+        return self.rate * work
+
+
+class PotentialRow():
+    __slots__ = ('potentials', 'start')
+
+    def __init__(self, potentials, start):
+        self.potentials = potentials
+        self.start = start
+
+    def __getitem__(self, col):
+        return PotentialSquare(self.potentials, self.start + col)
+
+
+class PotentialSquare():
+    """ Dict-like view of all the channels for a single square """
+    __slots__ = ('potentials', 'index')
+
+    def __init__(self, potentials, index):
+        self.potentials = potentials
+        self.index = index
+
+    def __getitem__(self, channel):
+        return self.potentials.data[
+            self.potentials.offsets[channel] + self.index]
+
+    def __setitem__(self, channel, value):
+        self.potentials.data[
+            self.potentials.offsets[channel] + self.index] = value
+
+    def keys(self):
+        return list(CHANNELS)
+
+    def iterkeys(self):
+        return iter(CHANNELS)
+
+
+class VisionMap():
+    """ Counts how many of our ants can see each square, indexed by row *
+    cols + col. The counts are moved along with the ants instead of being
+    stamped out again every turn, an ant that took one step only changes
+    the squares along the leading and trailing edges of its view. """
+
+    def __init__(self, rows, cols, viewradius2):
+        self.rows = rows
+        self.cols = cols
+        radius = int(math.sqrt(viewradius2))
+        self.offsets = [(d_row, d_col)
+                        for d_row in range(-radius, radius + 1)
+                        for d_col in range(-radius, radius + 1)
+                        if d_row ** 2 + d_col ** 2 <= viewradius2]
+
+        # Offsets from the square an ant left that come into view and that
+        # go out of view when it steps in each direction
+        in_view = set(self.offsets)
+        self.edges = {}
+        for s_row, s_col in AIM.values():
+            gained = [(d_row + s_row, d_col + s_col)
+                      for d_row, d_col in self.offsets
+                      if (d_row + s_row, d_col + s_col) not in in_view]
+            lost = [(d_row, d_col) for d_row, d_col in self.offsets
+                    if (d_row - s_row, d_col - s_col) not in in_view]
+            self.edges[(s_row, s_col)] = (gained, lost)
+
+        # Start of each row and each column for coordinates up to a step
+        # past a view radius off the map, so offsets wrap without a modulo
+        self.margin = radius + 1
+        self.row_starts = [(row % rows) * cols for row in
+                           xrange(-self.margin, rows + self.margin)]
+        self.col_at = [col % cols for col in
+                       xrange(-self.margin, cols + self.margin)]
+
+        self.count = array('H', [0]) * (rows * cols)
+        self.ants = set()
+
+    def stamp(self, loc, offsets, appeared):
+        """ Counts one more ant seeing the squares at offsets from loc, the
+        ones that were out of view go on appeared """
+        count = self.count
+        row_starts = self.row_starts
+        col_at = self.col_at
+        row = loc[0] + self.margin
+        col = loc[1] + self.margin
+        for d_row, d_col in offsets:
+            index = row_starts[row + d_row] + col_at[col + d_col]
+            if not count[index]:
+                appeared.append(index)
+            count[index] += 1
+
+    def unstamp(self, loc, offsets):
+        count = self.count
+        row_starts = self.row_starts
+        col_at = self.col_at
+        row = loc[0] + self.margin
+        col = loc[1] + self.margin
+        for d_row, d_col in offsets:
+            count[row_starts[row + d_row] + col_at[col + d_col]] -= 1
+
+    def update(self, ant_list):
+        """ Moves the counts from last turn's ants to ant_list and returns
+        the squares that came into view. An ant that could have stepped
+        from a square that was left empty is counted as having done so. """
+        rows = self.rows
+        cols = self.cols
+        ants = set(ant_list)
+        left = self.ants - ants
+        gains = []
+        losses = []
+        for loc in ants - self.ants:
+            row, col = loc
+            for step in self.edges:
+                previous = ((row - step[0]) % rows, (col - step[1]) % cols)
+                if previous in left:
+                    left.remove(previous)
+                    gained, lost = self.edges[step]
+                    gains.append((previous, gained))
+                    losses.append((previous, lost))
+                    break
+            else:
+                gains.append((loc, self.offsets))
+        for loc in left:
+            losses.append((loc, self.offsets))
+        self.ants = ants
+
+        # Gains go first so squares that stay in view never drop to 0, the
+        # ones that came into view and went straight out again are dropped
+        appeared = []
+        for loc, offsets in gains:
+            self.stamp(loc, offsets, appeared)
+        for loc, offsets in losses:
+            self.unstamp(loc, offsets)
+        count = self.count
+        return [index for index in appeared if count[index]]
+
+    def visible(self, row, col):
+        return self.count[row * self.cols + col] > 0
+
+
+class EntityViews():
+    """ The turn's ants, hills and food sorted by owner once in update(), so
+    the accessors on Ants hand out the same tuples every call and
+    membership tests can use the sets """
+
+    def __init__(self, ant_list, hill_list, food_list):
+        my_ants = []
+        enemy_ants = []
+        for loc, owner in ant_list.iteritems():
+            if owner == MY_ANT:
+                my_ants.append(loc)
+            else:
+                enemy_ants.append((loc, owner))
+        my_hills = []
+        enemy_hills = []
+        for loc, owner in hill_list.iteritems():
+            if owner == MY_ANT:
+                my_hills.append(loc)
+            else:
+                enemy_hills.append((loc, owner))
+
+        self.my_ants = tuple(my_ants)
+        self.my_ant_set = frozenset(my_ants)
+        self.enemy_ants = tuple(enemy_ants)
+        self.enemy_ant_set = frozenset([loc for loc, owner in enemy_ants])
+        self.my_hills = tuple(my_hills)
+        self.my_hill_set = frozenset(my_hills)
+        self.enemy_hills = tuple(enemy_hills)
+        self.enemy_hill_set = frozenset([loc for loc, owner in enemy_hills])
+        self.food = tuple(food_list)
+        self.food_set = frozenset(food_list)
+        # Worked out by Ants.plan_defense() once the views are built
+        self.defense_locations = ()
+
+
+class SpatialIndex():
+    """ One kind of ant, food or hill for the turn, sorted into buckets of
+    about BUCKET_SIZE squares a side so nearby queries only look at the
+    buckets in range. Distances wrap around the map edges and are compared
+    squared, like real_distance without the square root. """
+
+    def __init__(self, rows, cols, locations, size=BUCKET_SIZE):
+        self.rows = rows
+        self.cols = cols
+        # Buckets are spread evenly over the map, so none is narrower than
+        # the width used to bound how far away the next ring of them is
+        self.bucket_rows = max(1, rows // size)
+        self.bucket_cols = max(1, cols // size)
+        self.width = min(rows // self.bucket_rows, cols // self.bucket_cols)
+        self.buckets = defaultdict(list)
+        for loc in locations:
+            self.buckets[self.bucket(loc)].append(loc)
+
+    def bucket(self, loc):
+        return (loc[0] * self.bucket_rows // self.rows,
+                loc[1] * self.bucket_cols // self.cols)
+
+    def squared_distance(self, loc1, loc2):
+        d_row = abs(loc1[0] - loc2[0])
+        d_col = abs(loc1[1] - loc2[1])
+        d_row = min(d_row, self.rows - d_row)
+        d_col = min(d_col, self.cols - d_col)
+        return d_row * d_row + d_col * d_col
+
+    def span(self, centre, reach, size, buckets):
+        """ Buckets along one axis holding the squares within reach of
+        centre, wrapping around the map edge """
+        if 2 * reach + 1 >= size or buckets == 1:
+            return range(buckets)
+        start = (centre - reach) % size
+        end = (centre + reach) % size
+        first = start * buckets // size
+        last = end * buckets // size
+        if start <= end:
+            return range(first, last + 1)
+        if first <= last:
+            # Wrapped all the way round into the bucket it started in
+            return range(buckets)
+        return range(first, buckets) + range(0, last + 1)
+
+    def within(self, loc, radius):
+        """ Returns the locations closer to loc than radius """
+        radius2 = radius * radius
+        reach = int(radius)
+        row, col = loc
+        found = []
+        for bucket_row in self.span(row, reach, self.rows, self.bucket_rows):
+            for bucket_col in self.span(col, reach, self.cols,
+                                        self.bucket_cols):
+                for other in self.buckets.get((bucket_row, bucket_col), ()):
+                    if self.squared_distance(loc, other) < radius2:
+                        found.append(other)
+        return found
+
+    def nearest(self, loc, k=None, radius=None):
+        """ Returns the k locations nearest to loc, or all of them if k is
+        None, nearest first and only ones closer than radius if it is
+        given. Buckets are searched in rings outwards from loc's until
+        nothing further out could be nearer. """
+        centre_row, centre_col = self.bucket(loc)
+        rings = max(self.bucket_rows, self.bucket_cols) // 2 + 1
+        seen = set()
+        found = []
+        for ring in xrange(rings + 1):
+            for d_row in xrange(-ring, ring + 1):
+                for d_col in xrange(-ring, ring + 1):
+                    if max(abs(d_row), abs(d_col)) != ring:
+                        continue
+                    bucket = ((centre_row + d_row) % self.bucket_rows,
+                              (centre_col + d_col) % self.bucket_cols)
+                    if bucket in seen:
+                        continue
+                    seen.add(bucket)
+                    for other in self.buckets.get(bucket, ()):
+                        found.append((self.squared_distance(loc, other),
+                                      other))
+
+            # Anything in the next ring is at least this far away on one
+            # axis
+            beyond = ring * self.width + 1
+            if radius is not None and beyond >= radius:
+                break
+            if k is not None and len(found) >= k:
+                found.sort()
+                if found[k - 1][0] < beyond * beyond:
+                    break
+        found.sort()
+        if radius is not None:
+            radius2 = radius * radius
+            found = [(d, other) for d, other in found if d < radius2]
+        return [other for d, other in found[:k]]
+
+
 class Ants():
     def __init__(self):
         self.cols = None
@@ -80,10 +492,16 @@ class Ants():
         self.ant_list = {}
         self.dead_list = defaultdict(list)
         self.food_list = []
+        # The turn's ants, hills and food by owner, rebuilt in update()
+        self.views = EntityViews({}, {}, [])
         self.turntime = 0
         self.loadtime = 0
         self.turn_start_time = None
-        self.vision = None
+        # Built in setup(), tells us which squares our ants can see
+        self.vision_map = None
+        # The turn's ants sorted into buckets, built in update()
+        self.my_ant_index = None
+        self.enemy_ant_index = None
         self.viewradius2 = 0
         self.attackradius2 = 0
         self.spawnradius2 = 0
@@ -92,9 +510,66 @@ class Ants():
 
         self.diffusion_map = None
         self.potential_map = None
-        self.ant_locations = []
+        # Second buffer the diffusion passes write into before swapping
+        self.scratch_map = None
+
+        # Neighbour tables indexed by the flat row * cols + col index of a
+        # square, built once in setup()
+        self.locations = None
+        self.north_of = None
+        self.south_of = None
+        self.east_of = None
+        self.west_of = None
+        self.destinations = None
+        self.surrounding = None
+        self.adjacency = None
+        # Water squares we saw for the first time in the last update()
+        self.new_water = []
+        # Squares we saw for the first time in the last update() that
+        # turned out to be land
+        self.revealed = []
+        # Every row and column number as text, built in setup()
+        self.numbers = None
+
+        # Squares that changed in the last update() and the fixed potentials
+        # from the last diffusion, used by the incremental diffusion
+        self.dirty_squares = set()
+        self.last_sources = None
+        self.last_keep = None
+
+        # Thread relaxing the potentials between turns and the event that
+        # tells it to stop
+        self.background = None
+        self.background_stop = None
+
+        # (process, connection) for every diffusion process and the shared
+        # buffers behind the potential maps and the diffusion mask
+        self.pool = None
+        self.pool_buffers = None
+        self.pool_keep = None
+
+        # The pass each channel's residual first dropped under the
+        # convergence tolerance in the last full diffusion, None if it didn't
+        self.passes_to_converge = {}
+        # The residual each channel has to get under this turn
+        self.convergence_limit = None
+
+        # Telemetry for the latest diffusions, the current turn's is also
+        # turn_stats, and the model the passes use to tell if there's time
+        # for another one
+        self.diffusion_history = deque(maxlen=DIFFUSION_HISTORY)
+        self.turn_stats = None
+        self.pass_cost = PassCostModel()
+        # Flat indices of the squares our ants are on, or have been ordered
+        # onto, this turn. Reset in update(), issue_order() moves them.
+        self.occupied = set()
 
         self.turn_num = 0
+        # Last turn's ants, food and hills, kept from start_update() until
+        # finish_update() works out which squares changed
+        self.old_ants = {}
+        self.old_food = set()
+        self.old_hills = {}
 
         # Region map splits the map into 10x10 cells which we use to count
         # ants per region to attract ants to new areas
@@ -133,27 +608,86 @@ class Ants():
                     for row in range(self.rows)]
 
         # Just another name for a diffusion map
-        self.potential_map = [
-            [{'FOOD': 0, 'EXPLORE': 0, 'COMBAT': 0, 'ALLIED': 0, 'ENEMY': 0}
-                for col in range(self.cols)]
-                    for row in range(self.rows)]
+        self.potential_map = PotentialMap(self.rows, self.cols)
+        self.scratch_map = PotentialMap(self.rows, self.cols)
+
+        # Looking the numbers in the turn input up is quicker than int()
+        self.numbers = dict((str(number), number)
+                            for number in xrange(max(self.rows, self.cols)))
+        self.setup_neighbours()
+        self.vision_map = VisionMap(self.rows, self.cols, self.viewradius2)
 
         self.attackradius = math.sqrt(self.attackradius2)
 
-        self.region_rows = int(math.ceil(self.rows / 10.0))
-        self.region_cols = int(math.ceil(self.cols / 10.0))
+        self.region_rows = int(math.ceil(self.rows / float(REGION_SIZE)))
+        self.region_cols = int(math.ceil(self.cols / float(REGION_SIZE)))
 
         self.region_map = [[0 for col in range(self.region_cols)]
                     for row in range(self.region_rows)]
 
+    def setup_neighbours(self):
+        """ Precalculates the neighbours of every square so the hot paths
+        never have to wrap around the map edges themselves """
+        size = self.rows * self.cols
+        self.locations = [(index // self.cols, index % self.cols)
+                          for index in xrange(size)]
+        self.north_of = [((index // self.cols - 1) % self.rows) * self.cols +
+                         index % self.cols for index in xrange(size)]
+        self.south_of = [((index // self.cols + 1) % self.rows) * self.cols +
+                         index % self.cols for index in xrange(size)]
+        self.east_of = [index - index % self.cols + (index + 1) % self.cols
+                        for index in xrange(size)]
+        self.west_of = [index - index % self.cols + (index - 1) % self.cols
+                        for index in xrange(size)]
+
+        locations = self.locations
+        self.destinations = {
+            'n': [locations[index] for index in self.north_of],
+            's': [locations[index] for index in self.south_of],
+            'e': [locations[index] for index in self.east_of],
+            'w': [locations[index] for index in self.west_of]}
+        self.surrounding = [
+            [(self.destinations['n'][index], 'n'),
+             (self.destinations['s'][index], 's'),
+             (self.destinations['e'][index], 'e'),
+             (self.destinations['w'][index], 'w')]
+            for index in xrange(size)]
+
+        # Neighbours an ant can walk to, water is taken out as we find it
+        self.adjacency = [
+            [self.north_of[index], self.south_of[index],
+             self.east_of[index], self.west_of[index]]
+            for index in xrange(size)]
+
+    def remove_water(self, loc):
+        """ Takes a newly seen water square out of the adjacency lists """
+        row, col = loc
+        index = row * self.cols + col
+        for neighbour in self.adjacency[index]:
+            if index in self.adjacency[neighbour]:
+                self.adjacency[neighbour].remove(index)
+        self.adjacency[index] = []
+
     def update(self, data):
         'parse engine input and update the game state'
+        self.start_update()
+        for line in data.split('\n'):
+            self.update_line(line)
+        self.finish_update()
+
+    def start_update(self):
+        """ Starts a new turn, clearing last turn's ants, food and dead ants
+        off the map for update_line() to fill in again """
         # start timer
         self.turn_start_time = time.time()
         self.turn_num += 1
 
-        # reset vision
-        self.vision = None
+        # Remember what was on the map last turn so we know which squares
+        # need to be diffused again
+        self.old_ants = self.ant_list
+        self.old_food = set(self.food_list)
+        self.old_hills = dict(self.hill_list)
+        self.new_water = []
 
         for row, col in self.ant_list.keys():
             self.map[row][col] = LAND
@@ -165,63 +699,109 @@ class Ants():
             self.map[row][col] = LAND
         self.food_list = []
 
-        # update map and create new ant and food lists
-        for line in data.split('\n'):
-            line = line.strip().lower()
-            if len(line) > 0:
-                tokens = line.split()
-                if len(tokens) >= 3:
-                    row = int(tokens[1])
-                    col = int(tokens[2])
-                    if tokens[0] == 'w':
-                        self.map[row][col] = WATER
-                    elif tokens[0] == 'f':
-                        self.map[row][col] = FOOD
-                        self.food_list.append((row, col))
-                    else:
-                        owner = int(tokens[3])
-                        if tokens[0] == 'a':
-                            self.map[row][col] = owner
-                            self.ant_list[(row, col)] = owner
-                        elif tokens[0] == 'd':
-                            # food could spawn on a spot where an ant just died
-                            # don't overwrite the space unless it is land
-                            if self.map[row][col] == LAND:
-                                self.map[row][col] = DEAD
-                            # but always add to the dead list
-                            self.dead_list[(row, col)].append(owner)
-                        elif tokens[0] == 'h':
-                            owner = int(tokens[3])
-                            self.hill_list[(row, col)] = owner
-
-        for row in xrange(self.rows):
-            for col in xrange(self.cols):
-                if self.map[row][col] == UNKNOWN and self.visible((row, col)):
-                    self.map[row][col] = LAND
+    def update_line(self, line):
+        """ Reads one line of turn input straight into the map and the
+        entity lists. The first letter says what the line is, the ones we
+        don't need are skipped. """
+        numbers = self.numbers
+        kind = line[:1]
+        if kind == 'w':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            map_row = self.map[row]
+            if map_row[col] != WATER:
+                map_row[col] = WATER
+                self.new_water.append((row, col))
+        elif kind == 'a':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            owner = numbers[tokens[3]]
+            self.map[row][col] = owner
+            self.ant_list[(row, col)] = owner
+        elif kind == 'f':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            self.map[row][col] = FOOD
+            self.food_list.append((row, col))
+        elif kind == 'h':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            self.hill_list[(row, col)] = numbers[tokens[3]]
+        elif kind == 'd':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            # food could spawn on a spot where an ant just died
+            # don't overwrite the space unless it is land
+            if self.map[row][col] == LAND:
+                self.map[row][col] = DEAD
+            # but always add to the dead list
+            self.dead_list[(row, col)].append(numbers[tokens[3]])
+
+    def finish_update(self):
+        """ Works out the rest of the game state once the last line of the
+        turn has been read """
+        old_ants = self.old_ants
+        old_food = self.old_food
+        old_hills = self.old_hills
+        dirty = set()
+
+        for loc in self.new_water:
+            self.remove_water(loc)
+        dirty.update(self.new_water)
 
         # Remove our hills from the game if an enemy ant kills it
-        # So we don't keep defending a lost cause
-        for ((row, col), player) in self.enemy_ants():
-            if (row, col) in self.my_hills():
-                del self.hill_list[(row, col)]
-
-        # Store the ant locations since we will be updating it as the
-        # turn progresses
-        self.ant_locations = self.my_ants()
-        for row, col in self.ant_locations:
+        # So we don't keep defending a lost cause. We also know an enemy
+        # hill is destroyed when we have one of our ants standing on top
+        # of it!
+        for loc, owner in self.hill_list.items():
+            player = self.ant_list.get(loc)
+            if player is not None and \
+                    (player == MY_ANT) != (owner == MY_ANT):
+                del self.hill_list[loc]
+
+        self.views = EntityViews(self.ant_list, self.hill_list,
+                                 self.food_list)
+        self.plan_defense()
+
+        # Squares that came into view and weren't water are land
+        self.revealed = []
+        for index in self.vision_map.update(self.my_ants()):
+            row, col = self.locations[index]
+            if self.map[row][col] == UNKNOWN:
+                self.map[row][col] = LAND
+                self.revealed.append((row, col))
+        dirty.update(self.revealed)
+
+        # Our ants hold their squares until issue_order() moves them
+        self.occupied = set([row * self.cols + col
+                             for row, col in self.my_ants()])
+        for row, col in self.my_ants():
             # Update the region map
-            region_row = int(row / 10.0)
-            region_col = int(col / 10.0)
+            region_row = row // REGION_SIZE
+            region_col = col // REGION_SIZE
             self.region_map[region_row][region_col] = self.turn_num
 
-            # Update the hill list, we know a hill is destroyed when we have
-            # one of our ants standing on top of it!
-            enemy_hills = [(r, c)
-                for ((r, c), owner)
-                in self.enemy_hills()]
-
-            if (row, col) in enemy_hills:
-                del self.hill_list[(row, col)]
+        # Sort the turn's ants into buckets for the nearby queries
+        self.my_ant_index = SpatialIndex(self.rows, self.cols,
+                                         self.my_ants())
+        self.enemy_ant_index = SpatialIndex(self.rows, self.cols,
+                                            self.views.enemy_ant_set)
+
+        # Ants that moved, food that appeared or was eaten and hills that
+        # were found or razed
+        for loc in set(old_ants.keys()) | set(self.ant_list.keys()):
+            if old_ants.get(loc) != self.ant_list.get(loc):
+                dirty.add(loc)
+        dirty.update(old_food.symmetric_difference(self.food_list))
+        for loc in set(old_hills.keys()) | set(self.hill_list.keys()):
+            if old_hills.get(loc) != self.hill_list.get(loc):
+                dirty.add(loc)
+        self.dirty_squares = dirty
 
         # This is for debugging the region map only
         #for row in xrange(self.region_rows):
@@ -230,130 +810,900 @@ class Ants():
         #        output += str(self.region_map[row][col]).rjust(5)
         #    logging.info(output)
 
-    # TODO: This needs to be optimized way way more...
     def diffuse(self):
-        diffusion_count = 0
-
         # Keep 100ms available for ant processing, this is maybe overkill
         time_left = 100
-        time_remaining = self.time_remaining()
+        diffuse_start = time.time()
 
         pMap = self.get_fixed_potentials()
         self.set_fixed_potentials(pMap)
+        sources = dict(pMap.sources())
+        keep = self.diffusion_mask()
+        self.last_keep = keep
+
+        cells = self.rows * self.cols
+        self.turn_stats = {
+            'turn': self.turn_num,
+            'engine': None,
+            'cells': cells,
+            'sources': len(sources),
+            'channels_active': len(set(index // cells for index in sources)),
+            'work': PassCostModel.work(cells, len(CHANNELS), len(sources)),
+            'passes': 0,
+            'pass_ms': [],
+            'cells_processed': 0,
+            'ms': 0,
+        }
+        self.diffusion_history.append(self.turn_stats)
+
+        if DIFFUSION_MODE == 'BFS':
+            reached = self.diffuse_bfs(sources, keep)
+            self.last_sources = sources
+            self.finish_turn_stats('bfs', diffuse_start, reached)
+            logging.info("Reached " + str(reached) + " squares.")
+            return
+
+        if DIFFUSION_MODE == 'INCREMENTAL' and self.last_sources is not None:
+            changed = self.changed_squares(sources)
+            region = self.incremental_region(changed)
+            if region is not None:
+                relaxed = self.diffuse_incremental(keep, sources, changed,
+                                                   region, time_left)
+                self.last_sources = sources
+                self.finish_turn_stats('incremental', diffuse_start,
+                                       relaxed * len(CHANNELS))
+                logging.info("Relaxed " + str(relaxed) + " squares around " +
+                             str(len(changed)) + " changes.")
+                return
+
+        self.passes_to_converge = dict((channel, None)
+                                       for channel in CHANNELS)
+        self.convergence_limit = self.convergence_limits(sources.iteritems())
+        if DIFFUSION_MODE == 'MULTIGRID':
+            if numpy is not None:
+                self.diffuse_coarse(pMap, keep)
+            else:
+                logging.info("Multigrid diffusion needs numpy.")
+
+        if self.pool is not None:
+            engine = 'pool'
+            diffusion_count = self.diffuse_pool(keep, sources, time_left)
+        # The pool shuts itself down if a process fails to answer
+        if self.pool is None:
+            if numpy is not None:
+                engine = 'numpy'
+                diffusion_count = self.diffuse_numpy(pMap, keep, time_left)
+            else:
+                engine = 'python'
+                diffusion_count = self.diffuse_python(pMap, keep, time_left)
+        self.last_sources = sources
+        self.turn_stats['passes'] = diffusion_count
+        self.finish_turn_stats(engine, diffuse_start,
+                               diffusion_count * cells * len(CHANNELS))
 
-        # Create an ant map so we don't diffuse food potentials
-        ant_map = [
-            [False for col in xrange(self.cols)]
-                for row in xrange(self.rows)]
-        for row, col in self.my_ants():
-            ant_map[row][col] = True
+        # Before exiting give some useful info!
+        logging.info("Diffused " + str(diffusion_count) + " times.")
+        pass_ms = self.turn_stats['pass_ms']
+        if pass_ms:
+            logging.info("Pass cost: mean %.2fms, max %.2fms, predicted "
+                         "%.2fms." % (sum(pass_ms) / len(pass_ms),
+                                      max(pass_ms),
+                                      self.next_pass_cost(pass_ms[-1])))
+        if CONVERGENCE_RESIDUAL is not None:
+            logging.info("Passes to converge: " + ", ".join(
+                [channel + " " + str(self.passes_to_converge[channel])
+                 for channel in CHANNELS]))
+
+    def finish_turn_stats(self, engine, diffuse_start, cells_processed):
+        self.turn_stats['engine'] = engine
+        self.turn_stats['cells_processed'] = cells_processed
+        self.turn_stats['ms'] = (time.time() - diffuse_start) * 1000
+
+    def record_pass(self, ms, work=None):
+        """ Adds how long a diffusion pass took to this turn's telemetry and
+        the pass cost model, work defaults to a pass over every channel """
+        if work is None:
+            work = self.turn_stats['work']
+        self.turn_stats['pass_ms'].append(ms)
+        self.pass_cost.record(ms, work)
+
+    def next_pass_cost(self, last_pass):
+        """ Returns how many milliseconds the next pass over every channel
+        should take, falling back to how long the last one took until the
+        cost model has seen a pass """
+        predicted = self.pass_cost.predict(self.turn_stats['work'])
+        if predicted is None:
+            return last_pass
+        return predicted
+
+    def diffusion_stats(self):
+        """ Returns the telemetry for the latest turns of diffusion and the
+        pass cost model as plain dicts and lists """
+        pass_ms = [ms for stats in self.diffusion_history
+                   for ms in stats['pass_ms']]
+        stats = {
+            'turns': [dict(turn, pass_ms=list(turn['pass_ms']))
+                      for turn in self.diffusion_history],
+            'mean_pass_ms': None,
+            'max_pass_ms': None,
+            'ms_per_work': self.pass_cost.rate,
+            'predicted_pass_ms': None,
+        }
+        if pass_ms:
+            stats['mean_pass_ms'] = sum(pass_ms) / len(pass_ms)
+            stats['max_pass_ms'] = max(pass_ms)
+        if self.turn_stats is not None:
+            stats['predicted_pass_ms'] = self.pass_cost.predict(
+                self.turn_stats['work'])
+        return stats
+
+    def diffuse_bfs(self, sources, keep):
+        """ Sets every potential to its strongest source times BFS_DECAY for
+        each step it is away, with one breadth first search per channel
+        through the squares the channel can diffuse into. Returns the number
+        of squares reached over all the channels. """
+        size = self.rows * self.cols
+        adjacency = self.adjacency
+        keep = keep.data
+        data = self.potential_map.data
+        step = -math.log(BFS_DECAY)
+
+        channel_sources = [[] for channel in CHANNELS]
+        for index, value in sources.iteritems():
+            channel_sources[index // size].append((index % size, value))
+
+        reached = 0
+        for i, channel in enumerate(CHANNELS):
+            offset = i * size
+            for index in xrange(size):
+                data[offset + index] = 0
+            if not channel_sources[i]:
+                continue
+
+            # A weaker source starts its wave as many steps late as it
+            # takes the strongest source to decay to its value, so each
+            # square is reached first by the source that gives it the most
+            strongest = max([value for index, value in channel_sources[i]])
+            pending = defaultdict(list)
+            for index, value in channel_sources[i]:
+                delay = int(round(math.log(strongest / value) / step))
+                pending[delay].append((index, value))
+
+            visited = bytearray(size)
+            frontier = []
+            distance = 0
+            while frontier or pending:
+                for index, value in pending.pop(distance, ()):
+                    if not visited[index]:
+                        visited[index] = 1
+                        data[offset + index] = value
+                        frontier.append(index)
+
+                next_frontier = []
+                for index in frontier:
+                    value = data[offset + index] * BFS_DECAY
+                    for neighbour in adjacency[index]:
+                        if not visited[neighbour]:
+                            visited[neighbour] = 1
+                            # Squares that soak up the channel stay at 0 and
+                            # don't pass it on
+                            if keep[offset + neighbour]:
+                                data[offset + neighbour] = value
+                                next_frontier.append(neighbour)
+                reached += len(frontier)
+                frontier = next_frontier
+                distance = distance + 1
+
+        for index, value in sources.iteritems():
+            data[index] = value
+        return reached
+
+    def diffuse_coarse(self, pMap, keep):
+        """ Restricts the fixed potentials onto the region grid and relaxes
+        them there, where one pass moves a potential a whole region instead
+        of one square. The result is interpolated back onto the squares as
+        the starting point for the normal passes to smooth out. """
+        fixed = pMap.as_array()
+        keep = keep.as_array()
+        row_starts = numpy.arange(0, self.rows, REGION_SIZE)
+        col_starts = numpy.arange(0, self.cols, REGION_SIZE)
+
+        def restrict(values, ufunc):
+            return ufunc.reduceat(ufunc.reduceat(values, row_starts, axis=1),
+                                  col_starts, axis=2)
+
+        # A region holds its strongest fixed potential. Blocked squares soak
+        # up potentials, a region has to lose as much crossing it in one
+        # pass as REGION_SIZE passes over its squares would.
+        counts = restrict(numpy.ones((1, self.rows, self.cols)), numpy.add)
+        coarse_fixed = restrict(fixed, numpy.maximum)
+        open_squares = restrict(keep, numpy.add) / counts
+        loss = (1 - open_squares) / numpy.maximum(open_squares, 1e-6)
+        coarse_keep = 1 / (1 + loss * REGION_SIZE ** 2)
+        coarse_mask = coarse_fixed > 0
+
+        coarse = coarse_fixed.copy()
+        coarse_count = 0
+        while coarse_count < COARSE_MAX_PASSES:
+            coarse_count = coarse_count + 1
+            total = numpy.roll(coarse, 1, axis=1) + \
+                    numpy.roll(coarse, -1, axis=1) + \
+                    numpy.roll(coarse, 1, axis=2) + \
+                    numpy.roll(coarse, -1, axis=2)
+            total *= 0.25 * coarse_keep
+            numpy.copyto(total, coarse_fixed, where=coarse_mask)
+            settled = numpy.absolute(total - coarse) <= \
+                COARSE_TOLERANCE * total
+            coarse = total
+            if settled.all():
+                break
 
-        food_map = [
-            [False for col in xrange(self.cols)]
-                for row in xrange(self.rows)]
-        for row, col in self.food():
-            food_map[row][col] = True
+        # Interpolate between region centres, wrapping around the map edges.
+        # Potentials fall off exponentially so interpolate their logs.
+        def weights(count, regions):
+            position = (numpy.arange(count) + 0.5) / REGION_SIZE - 0.5
+            low = numpy.floor(position)
+            weight = (position - low).astype(numpy.float32)
+            low = low.astype(int) % regions
+            return low, (low + 1) % regions, weight
+
+        row_low, row_high, row_weight = weights(self.rows, self.region_rows)
+        col_low, col_high, col_weight = weights(self.cols, self.region_cols)
+        row_weight = row_weight[:, None]
+        coarse = numpy.log(numpy.maximum(coarse, 1e-38))
+        top = coarse[:, row_low, :]
+        bottom = coarse[:, row_high, :]
+        top = top[:, :, col_low] * (1 - col_weight) + \
+              top[:, :, col_high] * col_weight
+        bottom = bottom[:, :, col_low] * (1 - col_weight) + \
+                 bottom[:, :, col_high] * col_weight
+        fine = numpy.exp(top * (1 - row_weight) + bottom * row_weight)
+
+        current = self.potential_map.as_array()
+        current[...] = fine * keep
+        numpy.copyto(current, fixed, where=fixed > 0)
+        logging.info("Relaxed the region grid " + str(coarse_count) +
+                     " times.")
+
+    def convergence_limits(self, sources, first=0, last=len(CHANNELS),
+                           tolerance=CONVERGENCE_TOLERANCE):
+        """ Returns the residual each of channels first up to last has to
+        get under to have converged, tolerance of the largest of the (index,
+        value) fixed potentials in the channel """
+        size = self.rows * self.cols
+        largest = [0] * (last - first)
+        for index, value in sources:
+            channel = index // size - first
+            if 0 <= channel < last - first and value > largest[channel]:
+                largest[channel] = value
+        return [tolerance * value for value in largest]
+
+    def settled(self, residuals, limits):
+        """ Returns which channels have converged given the residual of
+        each channel for the last pass and the limits from
+        convergence_limits() """
+        return [residual <= limit
+                for residual, limit in zip(residuals, limits)]
+
+    def converged(self, residuals, diffusion_count):
+        """ Records which channels have converged given the residual of
+        each channel for the last pass, true once all of them have """
+        settled = self.settled(residuals, self.convergence_limit)
+        for channel, done in zip(CHANNELS, settled):
+            if done and self.passes_to_converge[channel] is None:
+                self.passes_to_converge[channel] = diffusion_count
+        return all(settled)
+
+    def changed_squares(self, sources):
+        """ Returns the flat indexes of the squares that changed since the
+        last diffusion, either in update() or in their fixed potentials """
+        size = self.rows * self.cols
+        changed = set(row * self.cols + col
+                      for row, col in self.dirty_squares)
+        for index in set(sources.keys()) | set(self.last_sources.keys()):
+            if sources.get(index) != self.last_sources.get(index):
+                changed.add(index % size)
+        return changed
+
+    def incremental_region(self, changed):
+        """ Returns a bytearray marking the squares within
+        INCREMENTAL_RADIUS steps of the changed squares, None if that is
+        too much of the map to be worth relaxing one square at a time """
+        size = self.rows * self.cols
+        limit = INCREMENTAL_MAX_DIRTY * size
+        region = bytearray(size)
+        for index in changed:
+            region[index] = 1
+        count = len(changed)
+        frontier = list(changed)
+        for step in xrange(INCREMENTAL_RADIUS):
+            if count > limit:
+                return None
+            next_frontier = []
+            for index in frontier:
+                for neighbour in (self.north_of[index], self.south_of[index],
+                                  self.east_of[index], self.west_of[index]):
+                    if not region[neighbour]:
+                        region[neighbour] = 1
+                        next_frontier.append(neighbour)
+            count += len(next_frontier)
+            frontier = next_frontier
+        if count > limit:
+            return None
+        return region
+
+    def diffuse_incremental(self, keep, sources, changed, region, time_left):
+        """ Warm starts from last turn's potentials and re-relaxes the
+        changed squares, spreading out to their neighbours in region until
+        the potentials settle or we run out of time. Returns the number of
+        squares relaxed. """
+        size = self.rows * self.cols
+        offsets = [i * size for i in xrange(len(CHANNELS))]
+        north_of = self.north_of
+        south_of = self.south_of
+        east_of = self.east_of
+        west_of = self.west_of
+        limits = zip(offsets, self.convergence_limits(
+            sources.iteritems(), tolerance=INCREMENTAL_TOLERANCE))
+
+        keep = keep.data
+        data = self.potential_map.data
+
+        queued = bytearray(size)
+        queue = deque(changed)
+        for index in changed:
+            queued[index] = 1
+
+        relaxed = 0
+        while queue:
+            # Checking the clock is slow, only do it every so often
+            if relaxed % 256 == 0 and self.time_remaining() < time_left:
+                logging.info("Ran out of time relaxing, " + str(len(queue)) +
+                             " squares left.")
+                break
+
+            index = queue.popleft()
+            queued[index] = 0
+            relaxed = relaxed + 1
+
+            neighbours = (north_of[index], south_of[index],
+                          east_of[index], west_of[index])
+            settled = True
+            for offset, limit in limits:
+                i = offset + index
+                if i in sources:
+                    value = sources[i]
+                else:
+                    total = data[offset + neighbours[0]] + \
+                            data[offset + neighbours[1]] + \
+                            data[offset + neighbours[2]] + \
+                            data[offset + neighbours[3]]
+                    value = max(0.25 * total, 0) * keep[i]
+                old = data[i]
+                if value != old:
+                    data[i] = value
+                    if abs(value - old) > limit:
+                        settled = False
+
+            if not settled:
+                for neighbour in neighbours:
+                    if region[neighbour] and not queued[neighbour]:
+                        queued[neighbour] = 1
+                        queue.append(neighbour)
+
+        return relaxed
 
-        # Store how long the last pass of diffusion took so we can accurately
+    # TODO: This needs to be optimized way way more...
+    def diffuse_python(self, pMap, keep, time_left):
+        """ Diffuses the potential map one square at a time until we run out
+        of time, returns the number of passes made """
+        diffusion_count = 0
+        time_remaining = self.time_remaining()
+
+        size = self.rows * self.cols
+        offsets = [i * size for i in xrange(len(CHANNELS))]
+        north = self.north_of
+        south = self.south_of
+        east = self.east_of
+        west = self.west_of
+
+        keep = keep.data
+        sources = pMap.sources()
+        fixed = bytearray(len(CHANNELS) * size)
+        for index, value in sources:
+            fixed[index] = 1
+        l1 = CONVERGENCE_RESIDUAL == 'L1'
+        current = self.potential_map
+        scratch = self.scratch_map
+
+        # Predict how long the next pass of diffusion will take so we can
         # stop diffusing with some time left over for processing the ants
         last_pass = 0
-        while time_remaining - last_pass > time_left:
+        while time_remaining - self.next_pass_cost(last_pass) > time_left:
             pass_start = time.time()
             diffusion_count = diffusion_count + 1
 
-            newMap = [[{
-                'FOOD': 0,
-                'EXPLORE': 0,
-                'COMBAT': 0,
-                'ALLIED': 0,
-                'ENEMY': 0} for col in xrange(self.cols)]
-                for row in xrange(self.rows)]
-
-            for row in xrange(self.rows):
-                for col in xrange(self.cols):
-
-                    # We never diffuse water!
-                    if self.map[row][col] == WATER:
-                        newMap[row][col]['FOOD'] = 0
-                        newMap[row][col]['EXPLORE'] = 0
-                        newMap[row][col]['COMBAT'] = 0
-                        newMap[row][col]['ALLIED'] = 0
-                        newMap[row][col]['ENEMY'] = 0
+            old = current.data
+            new = scratch.data
+            residuals = []
+            for offset in offsets:
+                residual = 0
+                for index in xrange(size):
+                    i = offset + index
+                    # Fixed potentials are written below, they never change
+                    if fixed[i]:
                         continue
+                    total = old[offset + north[index]] + \
+                            old[offset + south[index]] + \
+                            old[offset + east[index]] + \
+                            old[offset + west[index]]
+                    value = max(0.25 * total, 0) * keep[i]
+                    new[i] = value
+
+                    change = abs(value - old[i])
+                    if l1:
+                        residual += change
+                    elif change > residual:
+                        residual = change
+                residuals.append(residual)
+
+            for index, value in sources:
+                new[index] = value
+            current, scratch = scratch, current
 
-                    surrounding = self.surrounding_squares((row, col))
+            # Store how much time it took to run the diffusion pass
+            pass_end = time.time()
+            last_pass = (pass_end - pass_start) * 1000
+            self.record_pass(last_pass)
 
-                    food_total = sum([self.potential_map[r][c]['FOOD']
-                        for ((r, c), d) in surrounding])
-                    explore_total = sum([self.potential_map[r][c]['EXPLORE']
-                        for ((r, c), d) in surrounding])
-                    combat_total = sum([self.potential_map[r][c]['COMBAT']
-                        for ((r, c), d) in surrounding])
-                    allied_total = sum([self.potential_map[r][c]['ALLIED']
-                        for ((r, c), d) in surrounding])
-                    enemy_total = sum([self.potential_map[r][c]['ENEMY']
-                        for ((r, c), d) in surrounding])
-
-                    newMap[row][col]['FOOD'] = max(0.25 * food_total, 0)
-                    newMap[row][col]['EXPLORE'] = max(0.25 * explore_total, 0)
-
-                    # If we don't have the correct number of ants, don't even
-                    # diffuse combat, we shouldn't follow this path until we
-                    # are strong enough
-                    if len(self.my_ants()) >= ANTS_BEFORE_COMBAT:
-                        newMap[row][col]['COMBAT'] = max(0.25 * \
-                                                         combat_total, 0)
-                    else:
-                        newMap[row][col]['COMBAT'] = 0
+            if CONVERGENCE_RESIDUAL is not None and \
+                    self.converged(residuals, diffusion_count):
+                break
 
-                    newMap[row][col]['ALLIED'] = max(0.25 * allied_total, 0)
-                    newMap[row][col]['ENEMY'] = max(0.25 * enemy_total, 0)
+            time_remaining = self.time_remaining()
 
-                    # This is the lambda value in the diffusion equation
-                    # < 1 means competition
-                    # > 0 means coor
-                    if ant_map[row][col] == True:
-                        newMap[row][col]['FOOD'] = 0
-                        newMap[row][col]['EXPLORE'] = 0
-                        #newMap[row][col]['COMBAT'] *= 2
-                        newMap[row][col]['ENEMY'] = 0
+        self.potential_map = current
+        self.scratch_map = scratch
+        return diffusion_count
 
-                    if food_map[row][col] == True:
-                        newMap[row][col]['EXPLORE'] = 0
-                        newMap[row][col]['COMBAT'] = 0
+    def diffusion_mask(self):
+        """ Returns a PotentialMap of 1s and 0s, a 0 means the channel is
+        always reset to 0 on that square after a diffusion pass """
+        keep = PotentialMap(self.rows, self.cols, 1.0)
 
-            self.potential_map = newMap
-            self.set_fixed_potentials(pMap)
+        # We never diffuse water!
+        for row in xrange(self.rows):
+            for col in xrange(self.cols):
+                if self.map[row][col] == WATER:
+                    for channel in CHANNELS:
+                        keep.set(channel, row, col, 0)
+
+        # This is the lambda value in the diffusion equation
+        # < 1 means competition
+        # > 0 means coor
+        for row, col in self.my_ants():
+            keep.set('FOOD', row, col, 0)
+            keep.set('EXPLORE', row, col, 0)
+            keep.set('ENEMY', row, col, 0)
+
+        for row, col in self.food():
+            keep.set('EXPLORE', row, col, 0)
+            keep.set('COMBAT', row, col, 0)
+
+        # If we don't have the correct number of ants, don't even diffuse
+        # combat, we shouldn't follow this path until we are strong enough
+        if len(self.my_ants()) < ANTS_BEFORE_COMBAT:
+            offset = keep.offsets['COMBAT']
+            for index in xrange(keep.size):
+                keep.data[offset + index] = 0
+
+        return keep
+
+    def diffuse_numpy(self, pMap, keep, time_left):
+        """ Diffuses all the channels at once as a toroidal 4-neighbour stencil
+        until we run out of time, returns the number of passes made """
+        diffusion_count = 0
+        time_remaining = self.time_remaining()
+
+        current_map = self.potential_map
+        total_map = self.scratch_map
+        current = current_map.as_array()
+        total = total_map.as_array()
+        fixed = pMap.as_array()
+        fixed_mask = fixed > 0
+        keep = keep.as_array()
+        if CONVERGENCE_RESIDUAL is not None:
+            change = numpy.empty_like(current)
+            channel_change = change.reshape((len(CHANNELS), -1))
+
+        last_pass = 0
+        while time_remaining - self.next_pass_cost(last_pass) > time_left:
+            pass_start = time.time()
+            diffusion_count = diffusion_count + 1
+
+            self.average_numpy(current, total, keep)
+            numpy.copyto(total, fixed, where=fixed_mask)
+            current, total = total, current
+            current_map, total_map = total_map, current_map
+
+            if CONVERGENCE_RESIDUAL is not None:
+                numpy.subtract(current, total, out=change)
+                numpy.absolute(change, out=change)
+                if CONVERGENCE_RESIDUAL == 'L1':
+                    residuals = channel_change.sum(axis=1)
+                else:
+                    residuals = channel_change.max(axis=1)
 
-            # Store how much time it took to run the diffusion pass
             pass_end = time.time()
             last_pass = (pass_end - pass_start) * 1000
+            self.record_pass(last_pass)
+
+            if CONVERGENCE_RESIDUAL is not None and \
+                    self.converged(residuals, diffusion_count):
+                break
+
             time_remaining = self.time_remaining()
 
-        # Before exiting give some useful info!
-        logging.info("Diffused " + str(diffusion_count) + " times.")
+        self.potential_map = current_map
+        self.scratch_map = total_map
+        return diffusion_count
+
+    def average_numpy(self, current, total, keep):
+        """ Writes the average of each square's north, south, east and west
+        neighbours in current into total, wrapping around the map edges """
+        total[:, 1:, :] = current[:, :-1, :]
+        total[:, 0, :] = current[:, -1, :]
+        total[:, :-1, :] += current[:, 1:, :]
+        total[:, -1, :] += current[:, 0, :]
+        total[:, :, :-1] += current[:, :, 1:]
+        total[:, :, -1] += current[:, :, 0]
+        total[:, :, 1:] += current[:, :, :-1]
+        total[:, :, 0] += current[:, :, -1]
+
+        total *= 0.25
+        numpy.maximum(total, 0, out=total)
+        total *= keep
+
+    def start_background(self):
+        """ Starts relaxing last turn's potentials in a background thread,
+        call this once the turn is finished """
+        if not BACKGROUND_DIFFUSION or DIFFUSION_MODE == 'BFS' or \
+                self.last_sources is None or self.background is not None:
+            return
+        self.background_stop = threading.Event()
+        self.background = threading.Thread(
+            target=self.diffuse_background,
+            args=(self.last_keep, self.last_sources, self.background_stop))
+        # Don't keep the bot alive once the engine has gone
+        self.background.daemon = True
+        self.background.start()
+
+    def stop_background(self):
+        """ Stops the background diffusion and waits for it to hand back the
+        potential map, call this before touching the game state """
+        if self.background is None:
+            return
+        self.background_stop.set()
+        self.background.join()
+        self.background = None
+
+    def diffuse_background(self, keep, sources, stop):
+        """ Diffuses with the given mask and fixed potentials until stop is
+        set or every square settles. Only runs in the background thread, the
+        potential maps belong to it until stop_background() returns. """
+        try:
+            if numpy is not None:
+                diffusion_count = self.background_numpy(keep, sources, stop)
+            else:
+                diffusion_count = self.background_python(keep, sources, stop)
+            logging.info("Diffused " + str(diffusion_count) +
+                         " times in the background.")
+        except:
+            logging.info(str(traceback.format_exc()))
+
+    def background_numpy(self, keep, sources, stop):
+        """ Runs whole map passes like diffuse_numpy, they are short enough
+        to check for stop between them """
+        diffusion_count = 0
+        limits = self.convergence_limits(sources.iteritems())
+        current_map = self.potential_map
+        total_map = self.scratch_map
+        current = current_map.as_array()
+        total = total_map.as_array()
+        keep = keep.as_array()
+        indexes = numpy.array(sources.keys(), dtype=numpy.intp)
+        values = numpy.array(sources.values(), dtype=current.dtype)
+        change = numpy.empty_like(current)
+        channel_change = change.reshape((len(CHANNELS), -1))
+
+        while not stop.is_set():
+            diffusion_count = diffusion_count + 1
+            self.average_numpy(current, total, keep)
+            total.reshape(-1)[indexes] = values
+            current, total = total, current
+            current_map, total_map = total_map, current_map
+
+            numpy.subtract(current, total, out=change)
+            numpy.absolute(change, out=change)
+            if CONVERGENCE_RESIDUAL == 'L1':
+                residuals = channel_change.sum(axis=1)
+            else:
+                residuals = channel_change.max(axis=1)
+            if all(self.settled(residuals, limits)):
+                break
+
+        self.potential_map = current_map
+        self.scratch_map = total_map
+        return diffusion_count
+
+    def background_python(self, keep, sources, stop):
+        """ Relaxes the potential map in place one row at a time, a pass
+        takes too long to wait for so check for stop after every row """
+        diffusion_count = 0
+        size = self.rows * self.cols
+        offsets = [i * size for i in xrange(len(CHANNELS))]
+        north = self.north_of
+        south = self.south_of
+        east = self.east_of
+        west = self.west_of
+
+        keep = keep.data
+        data = self.potential_map.data
+        fixed = bytearray(len(CHANNELS) * size)
+        for index in sources:
+            fixed[index] = 1
+        limits = self.convergence_limits(sources.iteritems())
+        l1 = CONVERGENCE_RESIDUAL == 'L1'
+
+        while not stop.is_set():
+            diffusion_count = diffusion_count + 1
+            residuals = [0] * len(CHANNELS)
+            for start in xrange(0, size, self.cols):
+                if stop.is_set():
+                    return diffusion_count
+                for channel, offset in enumerate(offsets):
+                    residual = residuals[channel]
+                    for index in xrange(start, start + self.cols):
+                        i = offset + index
+                        if fixed[i]:
+                            continue
+                        total = data[offset + north[index]] + \
+                                data[offset + south[index]] + \
+                                data[offset + east[index]] + \
+                                data[offset + west[index]]
+                        value = max(0.25 * total, 0) * keep[i]
+                        change = abs(value - data[i])
+                        if l1:
+                            residual += change
+                        elif change > residual:
+                            residual = change
+                        data[i] = value
+                    residuals[channel] = residual
+            if all(self.settled(residuals, limits)):
+                break
+
+        return diffusion_count
+
+    def start_pool(self):
+        """ Moves the potential maps into shared memory and forks the
+        DIFFUSION_PROCESSES diffusion processes, call this once from
+        do_setup() so we never pay for the fork during a turn """
+        if not DIFFUSION_PROCESSES or self.pool is not None:
+            return
+        self.potential_map.data = multiprocessing.RawArray(
+            'f', self.potential_map.data)
+        self.scratch_map.data = multiprocessing.RawArray(
+            'f', self.scratch_map.data)
+        self.pool_buffers = (self.potential_map.data, self.scratch_map.data)
+        self.pool_keep = multiprocessing.RawArray(
+            'f', len(CHANNELS) * self.rows * self.cols)
+
+        processes = min(DIFFUSION_PROCESSES, len(CHANNELS))
+        bounds = [len(CHANNELS) * i // processes
+                  for i in xrange(processes + 1)]
+        self.pool = []
+        for first, last in zip(bounds, bounds[1:]):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=self.pool_worker, args=(child, first, last))
+            # Don't keep the bot alive once the engine has gone
+            process.daemon = True
+            process.start()
+            # Only the process keeps its end open, so we see EOF if it dies
+            child.close()
+            self.pool.append((process, connection))
+
+    def stop_pool(self):
+        """ Kills the diffusion processes, diffusion carries on in this
+        process on the potentials they leave in shared memory """
+        for process, connection in self.pool:
+            process.terminate()
+            process.join()
+            connection.close()
+        self.pool = None
+
+    def diffuse_pool(self, keep, sources, time_left):
+        """ Hands every diffusion process its channels' fixed potentials and
+        waits for them to diffuse until we run out of time, returns the most
+        passes any of them made. Returns None and stops the pool if one of
+        them fails or doesn't answer in time. """
+        # Slice assignment copies one float at a time, copy the bytes instead
+        ctypes.memmove(self.pool_keep, keep.data.buffer_info()[0],
+                       ctypes.sizeof(self.pool_keep))
+        current = self.pool_buffers.index(self.potential_map.data)
+        deadline = self.turn_start_time + \
+            (self.turntime - time_left) / 1000.0
+        for process, connection in self.pool:
+            connection.send((current, sources, deadline, self.pass_cost.rate))
+
+        diffusion_count = 0
+        for process, connection in self.pool:
+            remaining = deadline - time.time() + POOL_TIMEOUT / 1000.0
+            result = None
+            try:
+                if connection.poll(max(remaining, 0)):
+                    result = connection.recv()
+            except (EOFError, IOError):
+                pass
+            if result is None:
+                logging.info("A diffusion process didn't answer, diffusing "
+                             "without the pool from now on.")
+                self.stop_pool()
+                return None
+            count, converged, pass_ms, work = result
+            diffusion_count = max(diffusion_count, count)
+            self.passes_to_converge.update(converged)
+            for ms in pass_ms:
+                self.record_pass(ms, work)
+        return diffusion_count
+
+    def pool_worker(self, connection, first, last):
+        """ Runs in a diffusion process, diffuses channels first up to last
+        every time the main process sends it a turn """
+        while True:
+            try:
+                current, sources, deadline, rate = connection.recv()
+            except EOFError:
+                break
+            # Send None back rather than leave the main process waiting
+            try:
+                result = self.diffuse_block(first, last, current, sources,
+                                            deadline, rate)
+            except Exception:
+                logging.exception("Diffusion process failed")
+                result = None
+            connection.send(result)
+
+    def diffuse_block(self, first, last, current, sources, deadline, rate):
+        """ Diffuses channels first up to last of the shared potentials,
+        starting from pool_buffers[current] and leaving the result there.
+        rate is the pass cost model's milliseconds per unit of work. Returns
+        the number of passes, the pass each channel converged, how long each
+        pass took and how much work a pass is. """
+        size = self.rows * self.cols
+        start = first * size
+        end = last * size
+        old = self.pool_buffers[current]
+        new = self.pool_buffers[1 - current]
+        keep = self.pool_keep
+        sources = [(index, value) for index, value in sources.iteritems()
+                   if start <= index < end]
+        converged = dict((channel, None) for channel in CHANNELS[first:last])
+        limits = self.convergence_limits(sources, first, last)
+        work = PassCostModel.work(size, last - first, len(sources))
+        pass_ms = []
+        if numpy is not None:
+            shape = (len(CHANNELS), self.rows, self.cols)
+            old = numpy.frombuffer(old, numpy.float32).reshape(shape)
+            new = numpy.frombuffer(new, numpy.float32).reshape(shape)
+            keep = numpy.frombuffer(keep, numpy.float32).reshape(shape)
+            old_block = old[first:last]
+            new_block = new[first:last]
+            keep = keep[first:last]
+            indexes = numpy.array([index - start for index, value in sources],
+                                  dtype=numpy.intp)
+            values = numpy.array([value for index, value in sources],
+                                 dtype=numpy.float32)
+            change = numpy.empty_like(old_block)
+            block_change = change.reshape((last - first, -1))
+        else:
+            offsets = [i * size for i in xrange(first, last)]
+            north = self.north_of
+            south = self.south_of
+            east = self.east_of
+            west = self.west_of
+            fixed = bytearray(len(CHANNELS) * size)
+            for index, value in sources:
+                fixed[index] = 1
+            l1 = CONVERGENCE_RESIDUAL == 'L1'
+
+        # Predict how long the next pass will take from the cost model, like
+        # next_pass_cost() does, falling back to how long the last pass took
+        # until the model has seen one
+        diffusion_count = 0
+        next_pass = 0
+        if rate is not None:
+            next_pass = rate * work / 1000.0
+        while time.time() + next_pass < deadline:
+            pass_start = time.time()
+            diffusion_count = diffusion_count + 1
+
+            if numpy is not None:
+                self.average_numpy(old_block, new_block, keep)
+                new_block.reshape(-1)[indexes] = values
+                numpy.subtract(new_block, old_block, out=change)
+                numpy.absolute(change, out=change)
+                if CONVERGENCE_RESIDUAL == 'L1':
+                    residuals = block_change.sum(axis=1)
+                else:
+                    residuals = block_change.max(axis=1)
+                old_block, new_block = new_block, old_block
+            else:
+                residuals = []
+                for offset in offsets:
+                    residual = 0
+                    for index in xrange(size):
+                        i = offset + index
+                        if fixed[i]:
+                            continue
+                        total = old[offset + north[index]] + \
+                                old[offset + south[index]] + \
+                                old[offset + east[index]] + \
+                                old[offset + west[index]]
+                        value = max(0.25 * total, 0) * keep[i]
+                        new[i] = value
+
+                        change = abs(value - old[i])
+                        if l1:
+                            residual += change
+                        elif change > residual:
+                            residual = change
+                    residuals.append(residual)
+                for index, value in sources:
+                    new[index] = value
+                old, new = new, old
+
+            pass_ms.append((time.time() - pass_start) * 1000)
+            if CONVERGENCE_RESIDUAL is not None:
+                done = True
+                for channel, residual, limit in zip(CHANNELS[first:last],
+                                                    residuals, limits):
+                    if residual <= limit:
+                        if converged[channel] is None:
+                            converged[channel] = diffusion_count
+                    else:
+                        done = False
+                if done:
+                    break
+
+            if rate is None:
+                next_pass = pass_ms[-1] / 1000.0
+
+        # An odd number of passes leaves our channels in the other buffer
+        if diffusion_count % 2:
+            width = ctypes.sizeof(ctypes.c_float)
+            ctypes.memmove(
+                ctypes.byref(self.pool_buffers[current], start * width),
+                ctypes.byref(self.pool_buffers[1 - current], start * width),
+                (end - start) * width)
+        return diffusion_count, converged, pass_ms, work
 
     def set_fixed_potentials(self, pMap):
-        for row in xrange(self.rows):
-            for col in xrange(self.cols):
-                for k in pMap[row][col].iterkeys():
-                    if pMap[row][col][k] > 0:
-                        self.potential_map[row][col][k] = pMap[row][col][k]
+        data = self.potential_map.data
+        for index, value in pMap.sources():
+            data[index] = value
 
     def get_fixed_potentials(self):
         """ This should be called once per turn to get the potentials for
         things on the diffusion map """
 
-        newMap = [[
-            {'FOOD': 0, 'EXPLORE': 0, 'COMBAT': 0, 'ALLIED': 0, 'ENEMY': 0}
-            for col in xrange(self.cols)]
-            for row in xrange(self.rows)]
+        newMap = PotentialMap(self.rows, self.cols)
 
         ant_count = len(self.my_ants())
 
         # Do our own ants
         for (row, col) in self.my_ants():
-            newMap[row][col]['ALLIED'] = 1000
+            newMap.set('ALLIED', row, col, 1000)
 
             # TODO: Call for allied help?
             # if ant_count > ANTS_BEFORE_COMBAT:
@@ -365,7 +1715,7 @@ class Ants():
         # A hill count (our own hills should give an allied boost,
         # we dont' want to run from our own defense!)
         for (row, col) in self.my_hills():
-            newMap[row][col]['ALLIED'] = 3000
+            newMap.set('ALLIED', row, col, 3000)
 
             # Defend allied hills
             # If there are any enmies within x attack units,
@@ -373,24 +1723,24 @@ class Ants():
             radius = self.attackradius * 1.5
             nEnemies = len(self.enemy_ants_nearby((row, col), radius))
             if nEnemies > 0:
-                newMap[row][col]['COMBAT'] = DIFFUSION['DEFEND']
+                newMap.set('COMBAT', row, col, DIFFUSION['DEFEND'])
 
         # Do enemy ants
         for ((row, col), owner) in self.enemy_ants():
-            newMap[row][col]['ENEMY'] = 1000
+            newMap.set('ENEMY', row, col, 1000)
             if ant_count > ANTS_BEFORE_COMBAT:
                 # We can set the combat potential based on how "vulnerable"
                 # the target is?
-                diff = self.potential_map[row][col]['ALLIED'] - \
-                       self.potential_map[row][col]['ENEMY']
+                diff = self.potential_map.get('ALLIED', row, col) - \
+                       self.potential_map.get('ENEMY', row, col)
                 # The diff will be between -1000 and 1000, -1000 being
                 # strong enemy position.
-                newMap[row][col]['COMBAT'] = (1000 + diff)
+                newMap.set('COMBAT', row, col, 1000 + diff)
 
         # Fill in the food potential map
         food = self.food()
         for row, col in food:
-            newMap[row][col]['FOOD'] = DIFFUSION['FOOD']
+            newMap.set('FOOD', row, col, DIFFUSION['FOOD'])
 
         # Fill in the unknown potential map
         for row in xrange(self.rows):
@@ -407,35 +1757,42 @@ class Ants():
                     # If we know about some of it's neighbors then the square
                     # is on the "edge" of what we know about
                     if n > 0:
-                        newMap[row][col]['EXPLORE'] = DIFFUSION['UNKNOWN']
+                        newMap.set('EXPLORE', row, col, DIFFUSION['UNKNOWN'])
 
         # Fill in enemy ant hills
         hills = self.enemy_hills()
         for ((row, col), owner) in hills:
             if self.visible((row, col)):
-                newMap[row][col]['COMBAT'] = DIFFUSION['ENEMY_HILL_VISIBLE']
-                newMap[row][col]['ALLIED'] = 1000
+                newMap.set('COMBAT', row, col,
+                           DIFFUSION['ENEMY_HILL_VISIBLE'])
+                newMap.set('ALLIED', row, col, 1000)
             else:
-                newMap[row][col]['COMBAT'] = DIFFUSION['ENEMY_HILL']
+                newMap.set('COMBAT', row, col, DIFFUSION['ENEMY_HILL'])
             if len(self.my_ants()) > 30:
-                newMap[row][col]['COMBAT'] *= 2
+                newMap.set('COMBAT', row, col,
+                           newMap.get('COMBAT', row, col) * 2)
 
         # If there are defense positions that don't have ants, put some
         # weight there so we get some.
         for (row, col) in self.defense_locations():
-            if (row, col) not in self.my_ants():
+            if (row, col) not in self.views.my_ant_set:
                 # Pretend there is a food here to get an ant to come quickly
-                newMap[row][col]['FOOD'] = 1000
+                newMap.set('FOOD', row, col, 1000)
 
         return newMap
 
     def defense_locations(self):
         """ Gets a list of all the locations we should be staticly defending,
         every X ants we have should be one ant on defense. """
+        return self.views.defense_locations
+
+    def plan_defense(self):
+        """ Works out the turn's defense locations once the views are
+        built, defense_locations() hands them out after that """
         ant_count = len(self.my_ants())
 
         if ant_count < ANTS_BEFORE_DEFENDING:
-            return []
+            return
 
         ants_on_defense = int(ant_count / float(ANTS_PER_DEFENDER))
 
@@ -452,20 +1809,18 @@ class Ants():
 
         # Take the first "ants" on defense results from the list
         defense_positions = defense_positions[:ants_on_defense]
-        return defense_positions
+        self.views.defense_locations = tuple(defense_positions)
 
     def print_diffusion_map(self, map_type):
         for row in xrange(self.rows):
             line = ""
             for col in xrange(self.cols):
                 output = ""
-                if (row, col) in self.my_ants():
+                if (row, col) in self.views.my_ant_set:
                     output += "*" + \
                         str(self.potential_map[row][col]['ALLIED'] - \
                             self.potential_map[row][col]['ENEMY'])
-                elif (row, col) in [(r, c)
-                                    for ((r, c), owner)
-                                    in self.enemy_ants()]:
+                elif (row, col) in self.views.enemy_ant_set:
                     output += "@" + \
                         str(self.potential_map[row][col]['ALLIED'] - \
                         self.potential_map[row][col]['ENEMY'])
@@ -480,43 +1835,10 @@ class Ants():
             logging.info(line)
 
     def surrounding_squares(self, location):
-        """ Returns a list of ((row, col), 'direction') tuples"""
+        """ Returns a list of ((row, col), 'direction') tuples, the list is
+        shared so don't modify it """
         row, col = location
-        output = []
-
-        # NORTH
-        if row == 0:
-            loc = (self.rows - 1, col)
-            output.append((loc, 'n'))
-        else:
-            loc = (row - 1, col)
-            output.append((loc, 'n'))
-
-        # SOUTH
-        if row == self.rows - 1:
-            loc = (0, col)
-            output.append((loc, 's'))
-        else:
-            loc = (row + 1, col)
-            output.append((loc, 's'))
-
-        # EAST
-        if col == self.cols - 1:
-            loc = (row, 0)
-            output.append((loc, 'e'))
-        else:
-            loc = (row, col + 1)
-            output.append((loc, 'e'))
-
-        # WEST
-        if col == 0:
-            loc = (row, self.cols - 1)
-            output.append((loc, 'w'))
-        else:
-            loc = (row, col - 1)
-            output.append((loc, 'w'))
-
-        return output
+        return self.surrounding[row * self.cols + col]
 
     def unknown(self):
         output = []
@@ -535,9 +1857,9 @@ class Ants():
 
         src = (row, col)
         dest = self.destination(src, direction)
-        if src in self.ant_locations:
-            self.ant_locations.remove(src)    # Remove where we were
-        self.ant_locations.append(dest)    # Add where we're going!
+        # Remove where we were, add where we're going!
+        self.occupied.discard(row * self.cols + col)
+        self.occupied.add(dest[0] * self.cols + dest[1])
 
         sys.stdout.write('o %s %s %s\n' % (row, col, direction))
         sys.stdout.flush()
@@ -548,39 +1870,34 @@ class Ants():
         sys.stdout.flush()
 
     def my_hills(self):
-        return [loc for loc, owner in self.hill_list.items()
-                    if owner == MY_ANT]
+        return self.views.my_hills
 
     def enemy_hills(self):
-        return [(loc, owner) for loc, owner in self.hill_list.items()
-                    if owner != MY_ANT]
+        return self.views.enemy_hills
 
     def my_ants(self):
-        'return a list of all my ants'
-        return [(row, col) for (row, col), owner in self.ant_list.items()
-                    if owner == MY_ANT]
+        'return a tuple of all my ants'
+        return self.views.my_ants
 
     def enemy_ants(self):
-        'return a list of all visible enemy ants'
-        return [((row, col), owner)
-                    for (row, col), owner in self.ant_list.items()
-                    if owner != MY_ANT]
+        'return a tuple of all visible enemy ants'
+        return self.views.enemy_ants
 
     def food(self):
-        'return a list of all food locations'
-        return self.food_list[:]
+        'return a tuple of all food locations'
+        return self.views.food
 
     def passable(self, loc):
         'true if not water'
         row, col = loc
 
         # Don't let ants run into each other
-        if (row, col) in self.ant_locations:
+        if row * self.cols + col in self.occupied:
             return False
 
         # Don't let anys go somewhere they are goign to get killed?
-        diff = self.potential_map[row][col]['ALLIED'] - \
-               self.potential_map[row][col]['ENEMY']
+        diff = self.potential_map.get('ALLIED', row, col) - \
+               self.potential_map.get('ENEMY', row, col)
 
         if diff < ANT_RUN_AWAY:  # TODO: TWEAK THIS
             logging.info("Ant trying to move to " + str((row, col)) + \
@@ -594,36 +1911,27 @@ class Ants():
         if radius == None:
             radius = int(2 * self.attackradius)
 
-        nearby = []
-        mine = self.my_ants()
-        for (row, col) in mine:
-            if self.real_distance((row, col), loc) < radius:
-                nearby.append((row, col))
-        return nearby
+        return self.my_ant_index.within(loc, radius)
 
     def enemy_ants_nearby(self, loc, radius=None):
         """ Returns a list of enemy ants near the target location """
         if radius == None:
             radius = int(2 * self.attackradius)
 
-        nearby = []
-        enemies = self.enemy_ants()
-        for ((row, col), owner) in enemies:
-            if self.real_distance((row, col), loc) < radius:
-                nearby.append((row, col))
-
-        return nearby
+        return self.enemy_ant_index.within(loc, radius)
 
     def unoccupied(self, loc):
-        'true if no ants are at the location'
+        'true if no ants are at the location, or are going to be this turn'
         row, col = loc
-        return self.map[row][col] in (LAND, DEAD)
+        if row * self.cols + col in self.occupied:
+            return False
+        # Our ants that have been ordered away leave their square free
+        return self.map[row][col] in (LAND, DEAD, MY_ANT)
 
     def destination(self, loc, direction):
         'calculate a new location given the direction and wrap correctly'
         row, col = loc
-        d_row, d_col = AIM[direction]
-        return ((row + d_row) % self.rows, (col + d_col) % self.cols)
+        return self.destinations[direction][row * self.cols + col]
 
     def distance(self, loc1, loc2):
         'calculate the closest distance between to locations'
@@ -670,31 +1978,8 @@ class Ants():
 
     def visible(self, loc):
         ' determine which squares are visible to the given player '
-
-        if self.vision == None:
-            if not hasattr(self, 'vision_offsets_2'):
-                # precalculate squares around an ant to set as visible
-                self.vision_offsets_2 = []
-                mx = int(math.sqrt(self.viewradius2))
-                for d_row in range(-mx, mx + 1):
-                    for d_col in range(-mx, mx + 1):
-                        d = d_row ** 2 + d_col ** 2
-                        if d <= self.viewradius2:
-                            self.vision_offsets_2.append((
-                                # Create all negative offsets so vision will
-                                # wrap around the edges properly
-                                (d_row % self.rows) - self.rows,
-                                (d_col % self.cols) - self.cols
-                            ))
-            # set all spaces as not visible
-            # loop through ants and set all squares around ant as visible
-            self.vision = [[False] * self.cols for row in range(self.rows)]
-            for ant in self.my_ants():
-                a_row, a_col = ant
-                for v_row, v_col in self.vision_offsets_2:
-                    self.vision[a_row + v_row][a_col + v_col] = True
         row, col = loc
-        return self.vision[row][col]
+        return self.vision_map.visible(row, col)
 
     def render_text_map(self):
         'return a pretty string representing the map'
@@ -710,29 +1995,47 @@ class Ants():
         """parse input, update game state and call the bot classes do_turn
         method"""
         ants = Ants()
-        map_data = ''
+        # Settings are gathered up for setup(), turn lines go straight into
+        # the game state as they come in
+        setup_data = []
+        in_turn = False
         while(True):
             try:
-                # string new line char
-                current_line = sys.stdin.readline().rstrip('\r\n')
-                if current_line.lower() == 'ready':
-                    ants.setup(map_data)
-                    bot.do_setup(ants)
-                    ants.finish_turn()
-                    map_data = ''
-                elif current_line.lower() == 'go':
+                current_line = sys.stdin.readline()
+                if not current_line:
+                    # The engine has gone
+                    break
+                kind = current_line[:1]
+                if setup_data is not None:
+                    if current_line.rstrip('\r\n').lower() == 'ready':
+                        ants.setup(''.join(setup_data))
+                        bot.do_setup(ants)
+                        ants.finish_turn()
+                        setup_data = None
+                    else:
+                        setup_data.append(current_line)
+                    continue
+
+                if not in_turn:
+                    # The engine has started sending the next turn
+                    ants.stop_background()
+                    ants.start_update()
+                    in_turn = True
+                if kind == 'g':
+                    # The turn is over and the go line gets written even if
+                    # working out the game state or the orders fails
+                    in_turn = False
                     try:
-                        ants.update(map_data)
-                    # call the do_turn method of the class passed in
+                        ants.finish_update()
+                        # call the do_turn method of the class passed in
                         bot.do_turn(ants)
                     except:
-                        import traceback
                         formatted_lines = traceback.format_exc()
                         logging.info(str(formatted_lines))
                     ants.finish_turn()
-                    map_data = ''
+                    ants.start_background()
                 else:
-                    map_data += current_line + '\n'
+                    ants.update_line(current_line)
             except EOFError:
                 break
             except KeyboardInterrupt:
@@ -23,8 +23,6 @@ class MyBot:
     def do_turn(self, ants):
         # loop through all my ants and try to give them orders
         # the ant_loc is an ant location tuple in (row, col) form
-        
-        future_ants = []
         for ant_loc in ants.my_ants():
             # try all directions in RANDOM order
             directions = ['n', 'e', 's', 'w']
@@ -33,12 +31,11 @@ class MyBot:
                 directions.remove(direction)
                 
                 # Try to move the ant in the random direction, but only if it isn't
-                # water or one of our own ants.
+                # water or one of our own ants. issue_order() keeps track of
+                # where our ants are going so passable() avoids collisions.
                 new_loc = ants.destination(ant_loc, direction)
-                if ants.passable(new_loc) and not new_loc in future_ants:
+                if ants.passable(new_loc):
                     ants.issue_order((ant_loc, direction))
-                    # Save the new location in the future_ants so we can avoid collisions
-                    future_ants.append(new_loc)    
                     break
                     
             # check if we still have time left to calculate more orders
@@ -21,6 +21,9 @@ ORDERS = {
     'SIEGE': 4,     # Attack an enemy hill
 }
 
+# Orders that plan their moves around each other, in the order they plan
+PLAN_ORDER = [ORDERS['SIEGE'], ORDERS['FOOD'], ORDERS['EXPLORE'], ORDERS['PATROL']]
+
 # define a class with a do_turn method
 # the Ants.run method will parse and update bot input
 # it will also run the do_turn method for us
@@ -34,47 +37,64 @@ class MyBot:
     # the ants class is created and setup by the Ants.run method
     def do_setup(self, ants):
         # initialize data structures after learning the game settings
-        pass
-        
-    def move_to_target(self, ants, ant, current_orders):
-        target = current_orders[ant]['target']
-        directions = ants.direction(ant, target)
-        while directions:
-            direction = directions[0]
-            directions.remove(direction)
-            new_loc = ants.destination(ant, direction)
-            if ants.passable(new_loc):
-                ants.issue_order((ant, direction))
-                self.standing_orders[new_loc] = current_orders[ant]
-                return True
-        return False
-        
-    def move_along_path(self, ants, ant, current_orders):
-        """ Issue an order to move ant, along path"""
+        ants.setup_clusters()
+        ants.setup_landmarks()
         
-        path = current_orders[ant]['path']
+    def move_along_path(self, ants, ant, current_orders, last_try=True):
+        """ Plans ant's next few moves along its path, or towards its target
+        if it has no path, around the moves the other ants have planned and
+        issues the first one. Returns False if the ant has to wait, unless
+        this is its last try it then plans nothing so it can try again once
+        the other ants have moved. """
+        order = current_orders[ant]
+        path = order['path']
+        goal = order['target']
+        if path and ant in path:
+            index = path.index(ant) # Get the current location in the path
+            goal_index = min(index + RESERVATION_WINDOW, len(path) - 1)
+            goal = path[goal_index]
+
+        plan = ants.reservations.plan(ant, goal)
+        if not plan or len(plan) < 2 or plan[1] == ant:
+            if last_try:
+                ants.reservations.reserve(plan or [ant])
+            return False
+
+        ants.reservations.reserve(plan)
+        new_loc = plan[1]
+        ants.issue_order((ant, ants.direction(ant, new_loc)[0]))
+        if path and ant in path and new_loc != path[index + 1]:
+            # Took another way to get around an ant or to cut a corner,
+            # follow the planned squares back onto the path. If the plan
+            # ran out before it got there the path picks up again at the
+            # square it was heading for.
+            detour = [loc for turn, loc in enumerate(plan)
+                      if turn > 0 and loc != plan[turn - 1]]
+            if plan[-1] == goal:
+                order['path'] = detour + path[goal_index + 1:]
+            else:
+                order['path'] = detour + path[goal_index:]
+        self.standing_orders[new_loc] = order
+        return True
         
-        # If there is no path, just do a "dumb" move.
+    def repair_path(self, ants, ant, order):
+        """ Mends the path of a standing order that new water has cut, or
+        that the ant has ended up off, keeping the search behind it for the
+        next time. The path is mended to where it went, which is only part
+        of the way to the target for hierarchical paths. Returns False if
+        there is no way there any more, or no time to look for one. """
+        if ants.time_remaining() <= PATH_RESERVE * ants.turntime:
+            return False
+        if 'repair' not in order:
+            order['repair'] = PathRepair(ants, order['path'][-1])
+        path = order['repair'].find_path(ant)
         if not path:
-            return self.move_to_target(ants, ant, current_orders)
-        
-        index = path.index(ant) # Get the current location in the path
-        #logging.info("Ant at " + str(ant) + " going to " + str(current_orders[ant]['target']))
-        dest = path[index+1]    # Get the "next step"
-        
-        # Get the direction to move to get there
-        directions = ants.direction(ant, dest)
-        while directions:
-            direction = directions[0]
-            directions.remove(direction)
-            new_loc = ants.destination(ant, direction)
-            if ants.passable(new_loc):
-                ants.issue_order((ant, direction))
-                self.standing_orders[new_loc] = current_orders[ant]                        
-                return True
-                
-        return False    #Coudln't move the ant
-        
+            return False
+        order['path'] = path
+        order.pop('stale', None)
+        order['duration'] = len(path) + int(0.3 * len(path))
+        return True
+
     # do turn is run once per turn
     # the ants class has the game state and is updated by the Ants.run method
     # it also has several helper methods to use
@@ -87,7 +107,7 @@ class MyBot:
         
         current_orders = {}     # Current orders to execute this turn
         food_list = ants.food() # All the available food
-        available_food = ants.food()    # Food that isn't being targetted
+        available_food = list(ants.food())    # Food that isn't being targetted
         
         
         for ant in self.standing_orders.keys():
@@ -96,6 +116,7 @@ class MyBot:
                 available_food.remove(self.standing_orders[ant]['target'])
         
         ants_with_orders = self.standing_orders.keys()
+        needs_orders = []
         
         for ant in ants.my_ants():
             needs_order = True
@@ -108,152 +129,175 @@ class MyBot:
                 current_orders[ant] = self.standing_orders[ant]
                 current_orders[ant]['duration'] = current_orders[ant]['duration'] - 1                
 
-                # If we have reached the target (or timed out?)
+                # If we have reached the target (or timed out?), or the end of
+                # a path that only went part of the way there
                 target = current_orders[ant]['target']
-                if target == ant or current_orders[ant]['duration'] < 0 or ants.path_has_water(current_orders[ant]['path']):
+                path = current_orders[ant]['path']
+                if target == ant or current_orders[ant]['duration'] < 0 or (path and path[-1] == ant):
+                    needs_order = True
+                elif current_orders[ant].get('stale') or (path and ant not in path):
+                    # Mend the path rather than give up on the order
+                    needs_order = not self.repair_path(ants, ant, current_orders[ant])
+
+                if needs_order:
                     if ants.map[target[0]][target[1]] == -4:
                         logging.info("THE TARGET WAS WATER!")
-                    
-                    needs_order = True
                     del current_orders[ant]
 
-            if needs_order:                
-                # For now we jsut make the ant search out food (or sit still if it can't find any, i guess)
-                current_order = ORDERS['FOOD']
+            if needs_order:
+                needs_orders.append(ant)
 
-                # We should really just get a list of all ants near any hill, then be more specific later?
-                nearby_enemy_hills = ants.nearby_enemy_hills(ant)
-                if len(nearby_enemy_hills) > 0:
-                    current_order=ORDERS['SIEGE']
+        # We should really just get a list of all ants near any hill, then be more specific later?
+        enemy_hills = {}
+        for ant in needs_orders:
+            enemy_hills[ant] = ants.nearby_enemy_hills(ant)
 
-                ###############
-                # ORDER: FOOD #
-                ###############
-                if current_order == ORDERS['FOOD']:
-                    nearby_food = ants.nearby_food(ant, available_food)  
-                    
-                    food, path = ants.find_first_path(ant, nearby_food)
-                    if food:
-                        available_food.remove(food)
-                        current_orders[ant] = {
-                            'order': ORDERS['FOOD'],
-                            'target': food,
-                            'path': path,
-                            'duration': len(path) + int(0.3*len(path)),
-                        }
-                    # No food was found, either from a bad path or just no food in range
-                    else:
-                        # If we can't find food, patrol instead
-                        current_order = ORDERS['EXPLORE']
-                        if nearby_food:
-                            logging.info("Coudln't find a valid path to any of the food")
-                        else:
-                            logging.info("No nearby food!")
-                
-                ##################
-                # ORDER: EXPLORE #
-                ##################
-                if current_order == ORDERS['EXPLORE']:
-                    nearby_unknowns = ants.nearby_unknowns(ant)
-                
-                    dest, path = ants.find_first_path(ant, nearby_unknowns)
-                    if dest:
-                        current_orders[ant] = {
-                            'order': ORDERS['PATROL'],
-                            'target': dest,
-                            'path': path,
-                            'duration': len(path) + int(0.3 * len(path))
-                        }
-                    elif nearby_unknowns:
-                        dest = nearby_unknowns[0]
-                        current_orders[ant] = {
-                            'order': ORDERS['PATROL'],
-                            'target': dest,
-                            'path': None,
-                            'duration': int(ants.distance(dest, ant) * 1.3)
-                        }
-                    else:
-                        # If there are no nearby unknowns, just patrol
-                        current_order = ORDERS['PATROL']
-                                                
-                
-                ################
-                # ORDER: SIEGE #
-                ################
-                if current_order == ORDERS['SIEGE']:
-                    # nearby_enemy_hills calculated above
-                    dest, path = ants.find_first_path(ant, nearby_enemy_hills)
-                    if dest:
-                        current_orders[ant] = {
-                            'order': ORDERS['SIEGE'],
-                            'target': dest,
-                            'path': path,
-                            'duration': len(path) + int(0.3 * len(path))
-                        }
-                    else:
-                        current_order = ORDERS['PATROL']
-                        
-                #################
-                # ORDER: PATROL #
-                #################
-                if current_order == ORDERS['PATROL']:
-                    nearby_location = ants.nearby_location(ant)
+        # Match up all the available food with the closest ants that aren't
+        # sieging in one go
+        hungry = [ant for ant in needs_orders if not enemy_hills[ant]]
+        food_paths = {}
+        for ant, food, path in ants.assign_food(hungry, available_food, int(2 * ants.viewradius)):
+            food_paths[ant] = (food, path)
+
+        # Work out what each ant is going to do and queue up the path
+        # searches for the ones that need one
+        planned_orders = {}
+        for ant in needs_orders:
+            # For now we jsut make the ant search out food (or sit still if it can't find any, i guess)
+            current_order = ORDERS['FOOD']
+
+            nearby_enemy_hills = enemy_hills[ant]
+            if len(nearby_enemy_hills) > 0:
+                current_order=ORDERS['SIEGE']
+                ants.path_scheduler.request(ant, ant, nearby_enemy_hills,
+                                            'siege', search='hpa')
+            elif ant not in food_paths:
+                # No food was found, either from a bad path or just no food in range
+                # If we can't find food, explore instead
+                current_order = ORDERS['EXPLORE']
+                logging.info("No nearby food!")
+                ants.path_scheduler.request(ant, ant, ants.nearby_unknowns(ant),
+                                            'explore', search='hpa')
+            planned_orders[ant] = current_order
 
+        # Sieges first, then exploring, for as long as there is time
+        paths = ants.path_scheduler.run()
+
+        for ant in needs_orders:
+            current_order = planned_orders[ant]
+
+            ###############
+            # ORDER: FOOD #
+            ###############
+            if current_order == ORDERS['FOOD']:
+                food, path = food_paths[ant]
+                available_food.remove(food)
+                current_orders[ant] = {
+                    'order': ORDERS['FOOD'],
+                    'target': food,
+                    'path': path,
+                    'duration': len(path) + int(0.3*len(path)),
+                }
+            
+            ##################
+            # ORDER: EXPLORE #
+            ##################
+            if current_order == ORDERS['EXPLORE']:
+                dest, path = paths[ant]
+                if path:
                     current_orders[ant] = {
                         'order': ORDERS['PATROL'],
-                        'target': nearby_location,
+                        'target': dest,
+                        'path': path,
+                        'duration': len(path) + int(0.3 * len(path))
+                    }
+                elif dest:
+                    # The search was put off, head that way for now and
+                    # ask again next turn
+                    current_orders[ant] = {
+                        'order': ORDERS['PATROL'],
+                        'target': dest,
                         'path': None,
-                        'duration': int(ants.distance(nearby_location, ant) * 1.3)
-                    }                        
+                        'duration': 0
+                    }
+                else:
+                    # If there are no nearby unknowns, just patrol
+                    current_order = ORDERS['PATROL']
+                                            
+            
+            ################
+            # ORDER: SIEGE #
+            ################
+            if current_order == ORDERS['SIEGE']:
+                dest, path = paths[ant]
+                if path:
+                    current_orders[ant] = {
+                        'order': ORDERS['SIEGE'],
+                        'target': dest,
+                        'path': path,
+                        'duration': len(path) + int(0.3 * len(path))
+                    }
+                elif dest:
+                    current_orders[ant] = {
+                        'order': ORDERS['SIEGE'],
+                        'target': dest,
+                        'path': None,
+                        'duration': 0
+                    }
+                else:
+                    current_order = ORDERS['PATROL']
+                    
+            #################
+            # ORDER: PATROL #
+            #################
+            if current_order == ORDERS['PATROL']:
+                nearby_location = ants.nearby_location(ant)
 
-                
+                current_orders[ant] = {
+                    'order': ORDERS['PATROL'],
+                    'target': nearby_location,
+                    'path': None,
+                    'duration': int(ants.distance(nearby_location, ant) * 1.3)
+                }                        
+
+            
         logging.info("Ants: " + str(len(ants.my_ants())))
         logging.info("Orders: " + str(len(current_orders)))
         ################################
         # Execute the "current" orders #
         ################################
+        # Ants plan their moves one at a time around the ones already
+        # planned, most important orders first. Ants that would have to
+        # wait get another go as long as others keep moving out of the way.
         self.standing_orders = {}
+        ants.reservations.reset(ants.my_ants())
+        waiting = [ant for ant in current_orders.keys()
+                   if current_orders[ant]['order'] in PLAN_ORDER]
+        waiting.sort(key=lambda ant: PLAN_ORDER.index(current_orders[ant]['order']))
+        moving = True
+        while waiting and moving:
+            still_waiting = [ant for ant in waiting
+                             if not self.move_along_path(ants, ant, current_orders, last_try=False)]
+            moving = len(still_waiting) < len(waiting)
+            waiting = still_waiting
+
+        for ant in waiting:
+            ant_moved = self.move_along_path(ants, ant, current_orders)
+            if ant_moved == False:
+                current_order = current_orders[ant]['order']
+                order = [k for k, v in ORDERS.iteritems() if v == current_order][0]
+                logging.info(order.title() + " ant at " + str(ant) + " appears to be stuck!")
+
+        # Index the paths so new water marks the orders it cuts as stale
+        ants.order_index.track(self.standing_orders.values())
+
         for ant in current_orders.keys():
             current_order = current_orders[ant]['order']
-            
-            #################
-            # EXECUTE: FOOD #
-            #################
-            if current_order == ORDERS['FOOD']:  
-                ant_moved = self.move_along_path(ants, ant, current_orders)
-                if ant_moved == False:
-                    logging.info("Food ant at " + str(ant) + " appears to be stuck!")                    
-                    
-            ###################
-            # EXECUTE: PATROL #
-            ###################
-            elif current_order == ORDERS['PATROL']:
-                #ant_moved = self.move_along_path(ants, ant, current_orders)
-                ant_moved = self.move_along_path(ants, ant, current_orders)
-                
-                if ant_moved == False:
-                    logging.info("Patrol ant at " + str(ant) + " appears to be stuck!")
-                    
-            ####################
-            # EXECUTE: EXPLORE #
-            ####################
-            elif current_order == ORDERS['EXPLORE']:
-                ant_moved = self.move_along_path(ants, ant, current_orders)
-                if ant_moved == False:
-                    logging.info("Explore ant at " + str(ant) + " appears to be stuck!")
-                    
-            ###################
-            # EXECUTE: SIEGE #
-            ###################
-            elif current_order == ORDERS['SIEGE']:
-                ant_moved = self.move_along_path(ants, ant, current_orders)
-                if ant_moved == False:
-                    logging.info("Siege ant at " + str(ant) + " appears to be stuck!")
                     
             ####################
             # EXECUTE: NOTHING #
             ####################
-            elif current_order == ORDERS['NOTHING']:
+            if current_order == ORDERS['NOTHING']:
                 directions = ['n','s','e','w']
                 random.shuffle(directions)
                 while directions:
@@ -265,7 +309,7 @@ class MyBot:
                         break
                     
                     
-            else:
+            elif current_order not in PLAN_ORDER:
                 logging.info("Ant at " + str(ant) + " has an unknown order: " + str(current_order))                          
         
         # Calculate some turn statistics
@@ -277,6 +321,8 @@ class MyBot:
         stats['TOTAL_UNKNOWN'] = len(ants.unknown())
         stats['TOTAL_SIZE'] = ants.rows * ants.cols
         stats['PATH_CACHE_SIZE'] = len(ants.path_cache)
+        for name, count in ants.path_cache.stats().iteritems():
+            stats['PATH_CACHE_' + name.upper()] = count
         
         for ant_loc in self.standing_orders.keys():
             order = [k for k, v in ORDERS.iteritems() if v == self.standing_orders[ant_loc]['order']]
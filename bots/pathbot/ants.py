@@ -3,8 +3,10 @@ import sys
 import traceback
 import random
 import time
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from math import sqrt
+from array import array
+import heapq
 
 import logging
 
@@ -28,6 +30,67 @@ FOOD = -3
 WATER = -4
 UNKNOWN = -5
 
+# Most squares find_path will expand before giving up on a path, enough to
+# cross the biggest maps but stops us flooding a whole map looking for a
+# square we can't reach
+PATH_MAX_EXPANSIONS = 20000
+
+# Squares a path search expands between looking at the clock when it has a
+# deadline
+PATH_CHECK_EVERY = 256
+
+# Most paths the path cache holds before it drops the least recently used
+PATH_CACHE_LIMIT = 2000
+
+# Width and height of the clusters the hierarchical path search splits the
+# map into, paths shorter than two clusters are left to plain A*
+CLUSTER_SIZE = 10
+
+# Borders with an opening at least this wide get a crossing at both ends of
+# it, narrower ones just get one in the middle
+WIDE_ENTRANCE = 6
+
+# Landmarks the A* heuristic measures distances from, one is added a turn
+LANDMARKS = 8
+
+# Share of the map we have to have seen before landmarks are picked, any
+# earlier and they would all end up in the same corner
+LANDMARK_KNOWN = 0.25
+
+# Landmarks used in a single search, the ones with the best bound between
+# its start and end
+LANDMARK_ACTIVE = 3
+
+# Landmark distance tables repaired or built a turn, the rest wait with the
+# water they haven't seen yet
+LANDMARK_UPDATES = 1
+
+# Share of the map a repair can touch before it is cheaper to search the
+# whole table again
+LANDMARK_REPAIR_LIMIT = 0.1
+
+# Distance table entry for squares a landmark can't reach
+UNREACHED = 0xFFFF
+
+# Share of the turn time path searches leave for everything after them,
+# requests still waiting when we get down to it are put off
+PATH_RESERVE = 0.25
+
+# Order path requests are served in, most important first. Food isn't one
+# of them, assign_food() matches all the food to ants in one search before
+# the requests are served.
+PATH_PRIORITIES = ['siege', 'explore']
+
+# Turns ahead our ants plan their moves around each other
+RESERVATION_WINDOW = 4
+
+# Width and height of the buckets the spatial index sorts the turn's ants,
+# food and hills into
+BUCKET_SIZE = 8
+
+# Distance to the goal for squares a path repair hasn't reached
+NO_PATH = float('inf')
+
 PLAYER_ANT = 'abcdefghij'
 HILL_ANT = string = 'ABCDEFGHIJ'
 PLAYER_HILL = string = '0123456789'
@@ -51,6 +114,1183 @@ BEHIND = {'n': 's',
           'e': 'w',
           'w': 'e'}
 
+class PathCache():
+    """ Least recently used cache of paths keyed by (start, end). It also
+    indexes which paths go through every square so the paths through a
+    square that turns out to be water can be dropped straight away. """
+
+    def __init__(self, limit=PATH_CACHE_LIMIT):
+        self.limit = limit
+        self.paths = OrderedDict()
+        self.through = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get(self, start, end):
+        """ Returns the cached path from start to end or None """
+        key = (start, end)
+        path = self.paths.pop(key, None)
+        if path is None:
+            self.misses += 1
+            return None
+        # Move it to the most recently used end
+        self.paths[key] = path
+        self.hits += 1
+        return path
+
+    def put(self, start, end, path):
+        key = (start, end)
+        if key in self.paths:
+            self.remove(key)
+        elif len(self.paths) >= self.limit:
+            self.remove(next(iter(self.paths)))
+            self.evictions += 1
+        self.paths[key] = path
+        for loc in path:
+            self.through[loc].add(key)
+
+    def remove(self, key):
+        for loc in self.paths.pop(key):
+            keys = self.through[loc]
+            keys.discard(key)
+            if not keys:
+                del self.through[loc]
+
+    def invalidate(self, loc):
+        """ Drops every path going through loc """
+        for key in self.through.pop(loc, ()):
+            if key in self.paths:
+                self.remove(key)
+                self.invalidations += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class OrderIndex():
+    """ Indexes which squares the paths of the bot's standing orders go
+    through, the same way PathCache does for its paths, so new water marks
+    just the orders it cuts as stale instead of every path being checked
+    every turn. Orders are dicts with a 'path', and get 'stale' set. """
+
+    def __init__(self):
+        self.orders = {}
+        self.through = defaultdict(set)
+
+    def __len__(self):
+        return len(self.orders)
+
+    def track(self, orders):
+        """ Indexes the orders that are new or have a new path since the
+        last call and forgets the ones that are no longer standing """
+        keep = set()
+        for order in orders:
+            key = id(order)
+            keep.add(key)
+            entry = self.orders.get(key)
+            if entry is None or entry[1] is not order['path']:
+                self.forget(key)
+                if order['path']:
+                    self.orders[key] = (order, order['path'])
+                    for loc in order['path']:
+                        self.through[loc].add(key)
+        for key in [key for key in self.orders if key not in keep]:
+            self.forget(key)
+
+    def forget(self, key):
+        entry = self.orders.pop(key, None)
+        if entry is None:
+            return
+        for loc in entry[1]:
+            keys = self.through.get(loc)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.through[loc]
+
+    def add_water(self, loc):
+        """ Marks every order whose path goes through loc as stale """
+        for key in self.through.pop(loc, ()):
+            if key in self.orders:
+                self.orders[key][0]['stale'] = True
+
+
+class ClusterMap():
+    """ Hierarchical path finding (HPA*) graph. The map is split into
+    CLUSTER_SIZE square clusters, the squares paths can cross from one
+    cluster into the next are the nodes, and they are joined by the
+    distance between them inside their cluster. Clusters are rebuilt when
+    water is found in them, the next time we search. """
+
+    def __init__(self, ants):
+        self.ants = ants
+        rows = ants.rows
+        cols = ants.cols
+        self.cluster_rows = (rows + CLUSTER_SIZE - 1) // CLUSTER_SIZE
+        self.cluster_cols = (cols + CLUSTER_SIZE - 1) // CLUSTER_SIZE
+        self.cluster_of = [
+            (index // cols // CLUSTER_SIZE) * self.cluster_cols +
+            index % cols // CLUSTER_SIZE
+            for index in xrange(rows * cols)]
+
+        # Crossings are (square, square over the border) for every border,
+        # keyed by (cluster, 's') or (cluster, 'e') for the border to its
+        # south or east
+        self.crossings = {}
+        self.nodes = {}
+        self.inter = defaultdict(dict)
+        self.intra = {}
+        self.dirty = set(xrange(self.cluster_rows * self.cluster_cols))
+        self.refresh()
+
+    def neighbour_cluster(self, cluster, direction):
+        row, col = divmod(cluster, self.cluster_cols)
+        if direction == 's':
+            row = (row + 1) % self.cluster_rows
+        elif direction == 'n':
+            row = (row - 1) % self.cluster_rows
+        elif direction == 'e':
+            col = (col + 1) % self.cluster_cols
+        else:
+            col = (col - 1) % self.cluster_cols
+        return row * self.cluster_cols + col
+
+    def add_water(self, loc):
+        row, col = loc
+        self.dirty.add(self.cluster_of[row * self.ants.cols + col])
+
+    def border_squares(self, cluster, direction):
+        """ Returns (square, square over the border) for every square along
+        the south or east border of the cluster """
+        rows = self.ants.rows
+        cols = self.ants.cols
+        top = cluster // self.cluster_cols * CLUSTER_SIZE
+        left = cluster % self.cluster_cols * CLUSTER_SIZE
+        bottom = min(top + CLUSTER_SIZE, rows)
+        right = min(left + CLUSTER_SIZE, cols)
+        if direction == 's':
+            below = bottom % rows
+            return [((bottom - 1) * cols + col, below * cols + col)
+                    for col in xrange(left, right)]
+        beyond = right % cols
+        return [(row * cols + right - 1, row * cols + beyond)
+                for row in xrange(top, bottom)]
+
+    def build_border(self, cluster, direction):
+        key = (cluster, direction)
+        for a, b in self.crossings.pop(key, []):
+            self.inter[a].pop(b, None)
+            self.inter[b].pop(a, None)
+        if self.neighbour_cluster(cluster, direction) == cluster:
+            return
+
+        game_map = self.ants.map
+        locations = self.ants.locations
+        crossings = []
+        run = []
+        # The extra pair closes off a run that reaches the end of the border
+        for a, b in self.border_squares(cluster, direction) + [(None, None)]:
+            if a is not None:
+                row_a, col_a = locations[a]
+                row_b, col_b = locations[b]
+                if game_map[row_a][col_a] != WATER and \
+                        game_map[row_b][col_b] != WATER:
+                    run.append((a, b))
+                    continue
+            if len(run) >= WIDE_ENTRANCE:
+                crossings.extend((run[0], run[-1]))
+            elif run:
+                crossings.append(run[len(run) // 2])
+            run = []
+
+        for a, b in crossings:
+            self.inter[a][b] = 1
+            self.inter[b][a] = 1
+        self.crossings[key] = crossings
+
+    def cluster_nodes(self, cluster):
+        nodes = set()
+        for direction in 'se':
+            for a, b in self.crossings.get((cluster, direction), []):
+                nodes.add(a)
+        for direction in 'nw':
+            neighbour = self.neighbour_cluster(cluster, direction)
+            border = (neighbour, 's' if direction == 'n' else 'e')
+            for a, b in self.crossings.get(border, []):
+                nodes.add(b)
+        return nodes
+
+    def search_cluster(self, source):
+        """ Breadth first search from source that stays inside its cluster,
+        returns the distance and previous square of everything it reached """
+        adjacency = self.ants.adjacency
+        cluster_of = self.cluster_of
+        cluster = cluster_of[source]
+        distance = {source: 0}
+        came_from = {source: None}
+        queue = deque([source])
+        while queue:
+            x = queue.popleft()
+            for neighbour in adjacency[x]:
+                if neighbour not in distance and \
+                        cluster_of[neighbour] == cluster:
+                    distance[neighbour] = distance[x] + 1
+                    came_from[neighbour] = x
+                    queue.append(neighbour)
+        return distance, came_from
+
+    def build_cluster(self, cluster):
+        for node in self.nodes.get(cluster, ()):
+            self.intra.pop(node, None)
+        nodes = self.cluster_nodes(cluster)
+        self.nodes[cluster] = nodes
+        for node in nodes:
+            distance = self.search_cluster(node)[0]
+            self.intra[node] = dict((other, distance[other])
+                                    for other in nodes
+                                    if other != node and other in distance)
+
+    def refresh(self):
+        """ Rebuilds the clusters water was found in and the borders around
+        them, and any neighbours whose crossings changed """
+        if not self.dirty:
+            return
+        changed = set()
+        for cluster in self.dirty:
+            changed.add(cluster)
+            self.build_border(cluster, 's')
+            self.build_border(cluster, 'e')
+            for direction in 'nw':
+                neighbour = self.neighbour_cluster(cluster, direction)
+                self.build_border(neighbour, 's' if direction == 'n' else 'e')
+        for cluster in self.dirty:
+            for direction in 'nsew':
+                neighbour = self.neighbour_cluster(cluster, direction)
+                if self.cluster_nodes(neighbour) != \
+                        self.nodes.get(neighbour):
+                    changed.add(neighbour)
+        self.dirty = set()
+        for cluster in changed:
+            self.build_cluster(cluster)
+
+    def find_path(self, start, end, deadline=None):
+        """ Searches the cluster graph from start to end and returns the
+        path to the first square in the next cluster along the way, empty if
+        end can't be reached or the search runs past deadline """
+        self.refresh()
+        ants = self.ants
+        rows = ants.rows
+        cols = ants.cols
+        source = start[0] * cols + start[1]
+        target = end[0] * cols + end[1]
+        end_row, end_col = end
+
+        def distance(index):
+            row, col = divmod(index, cols)
+            d_row = abs(row - end_row)
+            d_col = abs(col - end_col)
+            return min(d_row, rows - d_row) + min(d_col, cols - d_col)
+
+        # Join start and end to the nodes of their clusters
+        start_distance, start_came_from = self.search_cluster(source)
+        end_distance = self.search_cluster(target)[0]
+        start_nodes = self.nodes[self.cluster_of[source]]
+        end_nodes = self.nodes[self.cluster_of[target]]
+
+        open_set = []
+        g_score = {}
+        came_from = {}
+        for node in start_nodes:
+            if node in start_distance:
+                g_score[node] = start_distance[node]
+                came_from[node] = source
+                h = distance(node)
+                heapq.heappush(open_set, (g_score[node] + h, h, node))
+        closed_set = set()
+        inter = self.inter
+        intra = self.intra
+
+        while open_set:
+            f, h, x = heapq.heappop(open_set)
+            if x in closed_set:
+                continue
+            if x == target:
+                break
+            closed_set.add(x)
+            if deadline is not None and \
+                    not len(closed_set) % PATH_CHECK_EVERY and \
+                    time.time() > deadline:
+                return []
+
+            edges = intra.get(x, {}).items() + inter[x].items()
+            if x in end_nodes and x in end_distance:
+                edges.append((target, end_distance[x]))
+            for neighbour, cost in edges:
+                tentative_g_score = g_score[x] + cost
+                if neighbour not in closed_set and tentative_g_score < \
+                        g_score.get(neighbour, tentative_g_score + 1):
+                    g_score[neighbour] = tentative_g_score
+                    came_from[neighbour] = x
+                    h = distance(neighbour)
+                    heapq.heappush(open_set,
+                                   (tentative_g_score + h, h, neighbour))
+        else:
+            return []
+
+        # Walk back to the first node out of the start cluster, then fill in
+        # the squares from start to it
+        abstract = [target]
+        while abstract[-1] != source:
+            abstract.append(came_from[abstract[-1]])
+        abstract.reverse()
+        start_cluster = self.cluster_of[source]
+        first = 1
+        while first < len(abstract) - 1 and \
+                self.cluster_of[abstract[first]] == start_cluster:
+            first += 1
+        exit_node = abstract[first - 1]
+
+        path = []
+        x = exit_node
+        while x is not None:
+            path.append(ants.locations[x])
+            x = start_came_from[x]
+        path.reverse()
+        path.append(ants.locations[abstract[first]])
+        return path
+
+
+class LandmarkMap():
+    """ Landmark (ALT) heuristic for A*. Keeps the breadth first distance
+    from each of a few landmarks to every square, and by the triangle
+    inequality the distance between two squares is at least the difference
+    of their distances to any landmark. Around water that is a much better
+    bound than the Manhattan distance.
+
+    Water only ever makes distances longer, so a table that hasn't caught
+    up with the latest water still gives a bound that never overestimates,
+    just a looser one. That lets the tables be repaired a few a turn. """
+
+    def __init__(self, ants):
+        self.ants = ants
+        size = ants.rows * ants.cols
+        self.landmarks = []
+        self.tables = []
+        # Water each table hasn't been repaired for yet
+        self.pending = []
+        # Squares we have seen, and squares we have stood on and so already
+        # marked everything around as seen
+        self.seen = bytearray(size)
+        self.visited = bytearray(size)
+        self.known = 0
+
+        radius = int(sqrt(ants.viewradius2))
+        self.vision_offsets = [
+            (d_row, d_col)
+            for d_row in xrange(-radius, radius + 1)
+            for d_col in xrange(-radius, radius + 1)
+            if d_row ** 2 + d_col ** 2 <= ants.viewradius2]
+
+    def look(self, ant_list):
+        """ Marks the squares around ants we haven't had one on before as
+        seen """
+        rows = self.ants.rows
+        cols = self.ants.cols
+        seen = self.seen
+        for row, col in ant_list:
+            index = row * cols + col
+            if self.visited[index]:
+                continue
+            self.visited[index] = 1
+            for d_row, d_col in self.vision_offsets:
+                square = (row + d_row) % rows * cols + (col + d_col) % cols
+                if not seen[square]:
+                    seen[square] = 1
+                    self.known += 1
+
+    def add_water(self, loc):
+        row, col = loc
+        index = row * self.ants.cols + col
+        if index in self.landmarks:
+            # Water is no use as a landmark, a new one is picked in its place
+            position = self.landmarks.index(index)
+            del self.landmarks[position]
+            del self.tables[position]
+            del self.pending[position]
+        for water in self.pending:
+            water.add(index)
+
+    def search(self, source):
+        """ Breadth first distances from source to every square """
+        adjacency = self.ants.adjacency
+        unreached = UNREACHED
+        table = array('H', [unreached]) * (self.ants.rows * self.ants.cols)
+        table[source] = 0
+        frontier = [source]
+        distance = 0
+        while frontier:
+            distance += 1
+            next_frontier = []
+            for x in frontier:
+                for neighbour in adjacency[x]:
+                    if table[neighbour] == unreached:
+                        table[neighbour] = distance
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+        return table
+
+    def repair(self, landmark, table, water):
+        """ Brings table up to date after water, which can only make
+        distances longer. Only the squares whose every shortest path went
+        through the new water are searched again, unless there are so many
+        that searching from the landmark is quicker. """
+        ants = self.ants
+        limit = LANDMARK_REPAIR_LIMIT * ants.rows * ants.cols
+        adjacency = ants.adjacency
+        neighbours_of = (ants.north_of, ants.south_of,
+                         ants.east_of, ants.west_of)
+
+        # Find the squares that lost their shortest path, nearest first, so
+        # every square's parents are settled before we look at it
+        affected = set()
+        levels = defaultdict(list)
+        for w in water:
+            if table[w] == UNREACHED:
+                continue
+            affected.add(w)
+            for neighbours in neighbours_of:
+                if table[neighbours[w]] == table[w] + 1:
+                    levels[table[w] + 1].append(neighbours[w])
+        while levels:
+            distance = min(levels)
+            for x in levels.pop(distance):
+                if x in affected:
+                    continue
+                for neighbour in adjacency[x]:
+                    if table[neighbour] == distance - 1 and \
+                            neighbour not in affected:
+                        break
+                else:
+                    affected.add(x)
+                    for neighbour in adjacency[x]:
+                        if table[neighbour] == distance + 1:
+                            levels[distance + 1].append(neighbour)
+            if len(affected) > limit:
+                table[:] = self.search(landmark)
+                return len(table)
+
+        # Search them again from the squares around them that kept theirs
+        for x in affected:
+            table[x] = UNREACHED
+        open_set = []
+        for x in affected:
+            if adjacency[x]:
+                distance = min(table[neighbour]
+                               for neighbour in adjacency[x]) + 1
+                if distance < UNREACHED:
+                    table[x] = distance
+                    heapq.heappush(open_set, (distance, x))
+        while open_set:
+            distance, x = heapq.heappop(open_set)
+            if distance > table[x]:
+                continue
+            for neighbour in adjacency[x]:
+                if table[neighbour] > distance + 1:
+                    table[neighbour] = distance + 1
+                    heapq.heappush(open_set, (distance + 1, neighbour))
+        return len(affected)
+
+    def refresh(self, ant_list):
+        """ Repairs the tables that are furthest behind on water, then picks
+        another landmark if there is time left this turn and we have seen
+        enough of the map """
+        updates = LANDMARK_UPDATES
+        behind = sorted(((len(water), position)
+                         for position, water in enumerate(self.pending)
+                         if water), reverse=True)
+        repaired = 0
+        for count, position in behind[:updates]:
+            repaired += self.repair(self.landmarks[position],
+                                    self.tables[position],
+                                    self.pending[position])
+            self.pending[position] = set()
+            updates -= 1
+        if behind:
+            logging.info("Repaired " + str(repaired) + " distances in " +
+                         str(len(behind[:LANDMARK_UPDATES])) + " of " +
+                         str(len(behind)) + " out of date landmark tables")
+
+        size = self.ants.rows * self.ants.cols
+        if not updates or len(self.landmarks) >= LANDMARKS or \
+                not ant_list or self.known < LANDMARK_KNOWN * size:
+            return
+
+        # Each new landmark is the seen square furthest from the ones we
+        # have, the first is the one furthest from our ants
+        if self.tables:
+            nearest = map(min, *self.tables) if len(self.tables) > 1 \
+                else self.tables[0]
+        else:
+            row, col = ant_list[0]
+            nearest = self.search(row * self.ants.cols + col)
+        seen = self.seen
+        water = self.ants.water
+        best = None
+        furthest = -1
+        for index in xrange(size):
+            distance = nearest[index]
+            if distance > furthest and distance != UNREACHED and \
+                    seen[index] and not water[index]:
+                best = index
+                furthest = distance
+        if best is None:
+            return
+        self.landmarks.append(best)
+        self.tables.append(self.search(best))
+        self.pending.append(set())
+        logging.info("Added landmark " + str(self.ants.locations[best]) +
+                     ", " + str(len(self.landmarks)) + " of " +
+                     str(LANDMARKS))
+
+    def bounds(self, source, target):
+        """ Returns (table, distance from landmark to target) for the
+        landmarks giving the best bound from source to target """
+        scored = []
+        for table in self.tables:
+            to_target = table[target]
+            if to_target != UNREACHED:
+                scored.append((abs(table[source] - to_target),
+                               table, to_target))
+        scored.sort(reverse=True)
+        return [(table, to_target)
+                for bound, table, to_target in scored[:LANDMARK_ACTIVE]]
+
+
+class ComponentMap():
+    """ Labels every square with the connected area of land it is in, so
+    targets we can't reach are turned down without a search. Squares we
+    haven't seen count as land, like they do in find_path. New water can
+    only split areas, and almost never does, so each clump of new water
+    first checks whether the squares around it can still reach each other
+    and the labels are only redone when they can't. """
+
+    def __init__(self, ants):
+        self.ants = ants
+        # -1 for water, everything starts out as one area
+        self.label = array('i', [0]) * (ants.rows * ants.cols)
+        self.next_label = 1
+        self.water = []
+
+    def add_water(self, loc):
+        row, col = loc
+        self.water.append(row * self.ants.cols + col)
+
+    def pieces(self, seeds, first=False):
+        """ Searches out from every seed at once and joins searches as they
+        meet. A search that runs out of squares before meeting the rest has
+        found a piece of the area that is cut off from them. Returns the
+        squares of every piece but the last one left, or just the first
+        piece found if first is set. Seeds that can all reach each other
+        stop as soon as they have met, without flooding the whole area. """
+        adjacency = self.ants.adjacency
+        parent = range(len(seeds))
+        owner = dict((seed, i) for i, seed in enumerate(seeds))
+        queues = [deque([seed]) for seed in seeds]
+
+        def find(i):
+            while parent[i] != i:
+                i = parent[i]
+            return i
+
+        pieces = []
+        roots = set(parent)
+        while len(roots) > 1:
+            for root in list(roots):
+                if root not in roots:
+                    continue
+                queue = queues[root]
+                if not queue:
+                    roots.remove(root)
+                    pieces.append([x for x, i in owner.iteritems()
+                                   if find(i) == root])
+                    if first or len(roots) == 1:
+                        return pieces
+                    continue
+                x = queue.popleft()
+                for neighbour in adjacency[x]:
+                    other = owner.get(neighbour)
+                    if other is None:
+                        owner[neighbour] = root
+                        queue.append(neighbour)
+                        continue
+                    other = find(other)
+                    if other != root:
+                        # The two searches have met, carry on as one
+                        parent[other] = root
+                        queue.extend(queues[other])
+                        queues[other] = None
+                        roots.remove(other)
+        return pieces
+
+    def refresh(self):
+        """ Works out which areas the water found since the last refresh
+        split up and gives the pieces new labels """
+        if not self.water:
+            return
+        ants = self.ants
+        is_water = ants.water
+        label = self.label
+        neighbours_of = (ants.north_of, ants.south_of,
+                         ants.east_of, ants.west_of)
+        water = set(self.water)
+        self.water = []
+
+        # Clumps of water squares next to each other are checked together,
+        # a path that crossed the clump could come out of it on any side.
+        # All the squares around a clump were in the same area before.
+        split = defaultdict(set)
+        while water:
+            clump = [water.pop()]
+            seeds = set()
+            for x in clump:
+                for neighbours in neighbours_of:
+                    neighbour = neighbours[x]
+                    if neighbour in water:
+                        water.remove(neighbour)
+                        clump.append(neighbour)
+                    elif not is_water[neighbour]:
+                        seeds.add(neighbour)
+            for x in clump:
+                label[x] = -1
+            if len(seeds) > 1 and self.pieces(list(seeds), first=True):
+                split[label[next(iter(seeds))]].update(seeds)
+
+        # Every piece of a split area is next to one of the clumps that
+        # split it, so searching from all their seeds together finds every
+        # piece. The last one left keeps the old label.
+        for old_label, seeds in split.iteritems():
+            sizes = []
+            for piece in self.pieces(list(seeds)):
+                for x in piece:
+                    label[x] = self.next_label
+                self.next_label += 1
+                sizes.append(len(piece))
+            logging.info("New water split " + str(len(sizes)) +
+                         " pieces of " + str(sorted(sizes)) +
+                         " squares off an area")
+
+    def reachable(self, index1, index2):
+        label = self.label[index1]
+        return label >= 0 and label == self.label[index2]
+
+
+class PathScheduler():
+    """ Queues up the turn's path searches and runs them most important
+    first for as long as the turn has time for. Requests that don't get a
+    search are put off, they get a destination back without a path so the
+    ant can head that way and ask again next turn. """
+
+    def __init__(self, ants):
+        self.ants = ants
+        self.requests = []
+        self.sequence = 0
+        self.served = defaultdict(int)
+        self.deferred = defaultdict(int)
+
+    def reset(self):
+        self.requests = []
+        self.served = defaultdict(int)
+        self.deferred = defaultdict(int)
+
+    def request(self, key, start, destinations, priority, search='astar'):
+        """ Asks for a path from start to the first of destinations we can
+        reach, priority is one of PATH_PRIORITIES and search is passed on
+        to find_first_path. The result comes back under key from run(). """
+        self.sequence += 1
+        heapq.heappush(self.requests,
+                       (PATH_PRIORITIES.index(priority), self.sequence,
+                        key, start, destinations, search))
+
+    def run(self):
+        """ Returns {key: (destination, path)} for every request. Like
+        find_first_path (None, None) means there was no path, a destination
+        with a path of None means the search was put off. """
+        ants = self.ants
+        reserve = PATH_RESERVE * ants.turntime
+        # Searches stop where the reserve starts rather than run into it
+        deadline = ants.turn_start_time + \
+            (ants.turntime - reserve) / 1000.0
+        results = {}
+        while self.requests:
+            priority, sequence, key, start, destinations, search = \
+                heapq.heappop(self.requests)
+            name = PATH_PRIORITIES[priority]
+            if ants.time_remaining() > reserve:
+                result = ants.find_first_path(start, destinations, search,
+                                              deadline)
+                if result[1] is None and ants.time_remaining() <= reserve:
+                    # Ran out of time rather than out of squares to search
+                    results[key] = self.defer(start, destinations)
+                    self.deferred[name] += 1
+                else:
+                    results[key] = result
+                    self.served[name] += 1
+            else:
+                results[key] = self.defer(start, destinations)
+                self.deferred[name] += 1
+        logging.info("Path requests served: " + str(dict(self.served)) +
+                     ", put off: " + str(dict(self.deferred)))
+        return results
+
+    def defer(self, start, destinations):
+        for d in destinations:
+            if self.ants.reachable(start, d):
+                return (d, None)
+        return (None, None)
+
+
+class ReservationTable():
+    """ Space-time reservations so our ants can plan their next few moves
+    around each other instead of walking into each other. Each planned ant
+    reserves the square it will be on for each of the next window turns,
+    and ants planned after it search over (square, turn) with waiting as a
+    move, so they step around it or wait for it to pass. Ants that haven't
+    been planned yet hold their square for every turn. """
+
+    def __init__(self, ants, window=RESERVATION_WINDOW):
+        self.ants = ants
+        self.window = window
+        self.size = ants.rows * ants.cols
+        # turn * size + square for every planned move
+        self.reserved = set()
+        self.held = set()
+
+    def reset(self, ant_list):
+        """ Starts a new turn with every one of ant_list holding its square
+        until it has a plan """
+        cols = self.ants.cols
+        self.reserved = set()
+        self.held = set([row * cols + col for row, col in ant_list])
+
+    def plan(self, start, goal):
+        """ Searches for the squares an ant at start should be on for the
+        next window turns on its way to goal, or until it gets there, with
+        A* over (square, turn). Returns the locations from start on, None
+        if it can't even stay where it is. """
+        ants = self.ants
+        rows = ants.rows
+        cols = ants.cols
+        size = self.size
+        window = self.window
+        adjacency = ants.adjacency
+        reserved = self.reserved
+        held = self.held
+        source = start[0] * cols + start[1]
+        target = goal[0] * cols + goal[1]
+        goal_row, goal_col = goal
+
+        def distance(index):
+            row, col = divmod(index, cols)
+            d_row = abs(row - goal_row)
+            d_col = abs(col - goal_col)
+            return min(d_row, rows - d_row) + min(d_col, cols - d_col)
+
+        # Every move, waiting included, costs a turn, so the first state
+        # off the heap at the end of the window is the one closest to goal
+        h = distance(source)
+        open_set = [(h, h, 0, source)]
+        came_from = {source: None}
+        while open_set:
+            f, h, turn, x = heapq.heappop(open_set)
+            state = turn * size + x
+            if turn == window or x == target:
+                plan = []
+                while state is not None:
+                    plan.append(ants.locations[state % size])
+                    state = came_from[state]
+                plan.reverse()
+                return plan
+
+            turn += 1
+            for y in adjacency[x] + [x]:
+                next_state = turn * size + y
+                if next_state in came_from or next_state in reserved or \
+                        (y in held and y != source):
+                    continue
+                came_from[next_state] = state
+                h = distance(y)
+                heapq.heappush(open_set, (turn + h, h, turn, y))
+        return None
+
+    def reserve(self, plan):
+        """ Reserves the squares of plan, and the last one for the rest of
+        the window as the ant will wait there until it plans again """
+        cols = self.ants.cols
+        size = self.size
+        squares = [row * cols + col for row, col in plan]
+        self.held.discard(squares[0])
+        for turn in xrange(1, self.window + 1):
+            index = squares[min(turn, len(squares) - 1)]
+            self.reserved.add(turn * size + index)
+
+
+class PathRepair():
+    """ Keeps the search behind a standing order's path so the path can be
+    mended when new water cuts it, or the ant wanders off it, instead of
+    searching again from scratch. This is D* Lite: it searches back from
+    the goal, so the ant moving only shifts the heuristic, and new water
+    only reopens the squares whose distance to the goal it changed. Our
+    ants aren't barriers here, the reservation table steps around them. """
+
+    def __init__(self, ants, goal):
+        self.ants = ants
+        self.goal = goal[0] * ants.cols + goal[1]
+        # Distance to goal as of the last expansion, and the best distance
+        # the neighbours give, squares where they differ are queued
+        self.g = {}
+        self.rhs = {self.goal: 0}
+        self.keys = {}
+        self.queue = []
+        # Heuristic offset for the ant having moved since keys were queued
+        self.offset = 0
+        self.last = None
+        self.row = None
+        self.col = None
+        # Water in ants.water_log the search has taken out so far
+        self.water_seen = 0
+
+    def distance(self, index1, index2):
+        ants = self.ants
+        row1, col1 = divmod(index1, ants.cols)
+        row2, col2 = divmod(index2, ants.cols)
+        d_row = abs(row1 - row2)
+        d_col = abs(col1 - col2)
+        return min(d_row, ants.rows - d_row) + min(d_col, ants.cols - d_col)
+
+    def key(self, x):
+        """ D* Lite's queue key for x. Ties go first to squares that got
+        further from the goal, the squares past them may still count on
+        the old distance, then to the squares nearest the ant like in
+        find_path. """
+        ants = self.ants
+        g = self.g.get(x, NO_PATH)
+        rhs = self.rhs.get(x, NO_PATH)
+        row, col = ants.locations[x]
+        d_row = abs(row - self.row)
+        d_col = abs(col - self.col)
+        h = min(d_row, ants.rows - d_row) + min(d_col, ants.cols - d_col)
+        if g < rhs:
+            return (g + h + self.offset, 0, g)
+        return (rhs + h + self.offset, 1, -rhs)
+
+    def queue_square(self, x):
+        if self.g.get(x, NO_PATH) != self.rhs.get(x, NO_PATH):
+            key = self.key(x)
+            self.keys[x] = key
+            heapq.heappush(self.queue, (key, x))
+        elif x in self.keys:
+            del self.keys[x]
+
+    def update_square(self, x):
+        if x != self.goal:
+            g = self.g
+            best = NO_PATH
+            for y in self.ants.adjacency[x]:
+                d = g.get(y, NO_PATH) + 1
+                if d < best:
+                    best = d
+            self.rhs[x] = best
+        self.queue_square(x)
+
+    def add_water(self):
+        """ Takes the water found since the last call out of the search """
+        ants = self.ants
+        water_log = ants.water_log
+        neighbours_of = (ants.north_of, ants.south_of,
+                         ants.east_of, ants.west_of)
+        for x in water_log[self.water_seen:]:
+            self.g.pop(x, None)
+            self.rhs[x] = NO_PATH
+            self.keys.pop(x, None)
+            for neighbours in neighbours_of:
+                neighbour = neighbours[x]
+                if not ants.water[neighbour]:
+                    self.update_square(neighbour)
+        self.water_seen = len(water_log)
+
+    def first_search(self, source):
+        """ Plain A* back from the goal to source for the first path,
+        it settles the same squares search() would with less bookkeeping.
+        The squares it leaves open are queued for the repairs. Returns
+        False if that took more than PATH_MAX_EXPANSIONS. """
+        ants = self.ants
+        rows = ants.rows
+        cols = ants.cols
+        locations = ants.locations
+        adjacency = ants.adjacency
+        g = self.g
+        rhs = self.rhs
+        start_row = self.row
+        start_col = self.col
+
+        def distance(index):
+            row, col = locations[index]
+            d_row = abs(row - start_row)
+            d_col = abs(col - start_col)
+            return min(d_row, rows - d_row) + min(d_col, cols - d_col)
+
+        h = distance(self.goal)
+        open_set = [(h, h, self.goal)]
+        while open_set:
+            f, h, x = heapq.heappop(open_set)
+            if x in g:
+                continue
+            g[x] = d = rhs[x]
+            if x == source:
+                break
+            if len(g) > PATH_MAX_EXPANSIONS:
+                return False
+            d += 1
+            for y in adjacency[x]:
+                if y not in g and d < rhs.get(y, NO_PATH):
+                    rhs[y] = d
+                    h = distance(y)
+                    heapq.heappush(open_set, (d + h, h, y))
+
+        for x in rhs:
+            if x not in g:
+                self.queue_square(x)
+        return source in g
+
+    def search(self, source):
+        """ Expands squares until source's distance to goal is settled,
+        returns False if that took more than PATH_MAX_EXPANSIONS """
+        adjacency = self.ants.adjacency
+        g = self.g
+        rhs = self.rhs
+        keys = self.keys
+        queue = self.queue
+        expanded = 0
+        while queue:
+            key, x = queue[0]
+            if keys.get(x) != key:
+                # Stale entry, the square was queued again or settled
+                heapq.heappop(queue)
+                continue
+            if key >= self.key(source) and \
+                    rhs.get(source, NO_PATH) == g.get(source, NO_PATH):
+                break
+            heapq.heappop(queue)
+            expanded += 1
+            if expanded > PATH_MAX_EXPANSIONS:
+                return False
+
+            new_key = self.key(x)
+            if key < new_key:
+                # The ant has moved since x was queued
+                keys[x] = new_key
+                heapq.heappush(queue, (new_key, x))
+                continue
+            del keys[x]
+            if g.get(x, NO_PATH) > rhs[x]:
+                g[x] = d = rhs[x]
+                d += 1
+                for y in adjacency[x]:
+                    if d < rhs.get(y, NO_PATH):
+                        rhs[y] = d
+                        self.queue_square(y)
+            else:
+                # x got further away, so did everything that went through it
+                old = g.pop(x, NO_PATH) + 1
+                self.queue_square(x)
+                for y in adjacency[x]:
+                    if rhs.get(y, NO_PATH) == old:
+                        self.update_square(y)
+        return rhs.get(source, NO_PATH) == g.get(source, NO_PATH)
+
+    def find_path(self, start):
+        """ Returns the locations of a shortest path from start to the goal,
+        or an empty list if there isn't one """
+        ants = self.ants
+        if not ants.reachable(start, ants.locations[self.goal]):
+            return []
+        source = start[0] * ants.cols + start[1]
+        if self.last is None:
+            self.last = source
+            self.row, self.col = start
+            # Water found before now is already out of adjacency
+            self.water_seen = len(ants.water_log)
+            found = self.first_search(source)
+        else:
+            if source != self.last:
+                self.offset += self.distance(self.last, source)
+                self.last = source
+                self.row, self.col = start
+            self.add_water()
+            found = self.search(source)
+        if not found:
+            logging.info("Gave up mending a path from " + str(start) +
+                         " to " + str(ants.locations[self.goal]) +
+                         " after " + str(PATH_MAX_EXPANSIONS) + " squares")
+            return []
+
+        g = self.g
+        if g.get(source, NO_PATH) == NO_PATH:
+            return []
+
+        # Walk down the distances to the goal
+        adjacency = ants.adjacency
+        x = source
+        path = [start]
+        for step in xrange(g[source]):
+            x = min(adjacency[x], key=lambda y: g.get(y, NO_PATH))
+            path.append(ants.locations[x])
+        if x != self.goal:
+            return []
+        return path
+
+
+class EntityViews():
+    """ The turn's ants, hills and food sorted by owner once in update(), so
+    the accessors on Ants hand out the same tuples every call and
+    membership tests can use the sets """
+
+    def __init__(self, ant_list, hill_list, food_list):
+        my_ants = []
+        enemy_ants = []
+        for loc, owner in ant_list.iteritems():
+            if owner == MY_ANT:
+                my_ants.append(loc)
+            else:
+                enemy_ants.append((loc, owner))
+        my_hills = []
+        enemy_hills = []
+        for loc, owner in hill_list.iteritems():
+            if owner == MY_ANT:
+                my_hills.append(loc)
+            else:
+                enemy_hills.append((loc, owner))
+
+        self.my_ants = tuple(my_ants)
+        self.my_ant_set = frozenset(my_ants)
+        self.enemy_ants = tuple(enemy_ants)
+        self.enemy_ant_set = frozenset([loc for loc, owner in enemy_ants])
+        self.my_hills = tuple(my_hills)
+        self.my_hill_set = frozenset(my_hills)
+        self.enemy_hills = tuple(enemy_hills)
+        self.enemy_hill_set = frozenset([loc for loc, owner in enemy_hills])
+        self.food = tuple(food_list)
+        self.food_set = frozenset(food_list)
+
+
+class SpatialIndex():
+    """ One kind of ant, food or hill for the turn, sorted into buckets of
+    about BUCKET_SIZE squares a side so nearby queries only look at the
+    buckets in range. Distances wrap around the map edges and are compared
+    squared, like real_distance without the square root. """
+
+    def __init__(self, rows, cols, locations, size=BUCKET_SIZE):
+        self.rows = rows
+        self.cols = cols
+        # Buckets are spread evenly over the map, so none is narrower than
+        # the width used to bound how far away the next ring of them is
+        self.bucket_rows = max(1, rows // size)
+        self.bucket_cols = max(1, cols // size)
+        self.width = min(rows // self.bucket_rows, cols // self.bucket_cols)
+        self.buckets = defaultdict(list)
+        for loc in locations:
+            self.buckets[self.bucket(loc)].append(loc)
+
+    def bucket(self, loc):
+        return (loc[0] * self.bucket_rows // self.rows,
+                loc[1] * self.bucket_cols // self.cols)
+
+    def squared_distance(self, loc1, loc2):
+        d_row = abs(loc1[0] - loc2[0])
+        d_col = abs(loc1[1] - loc2[1])
+        d_row = min(d_row, self.rows - d_row)
+        d_col = min(d_col, self.cols - d_col)
+        return d_row * d_row + d_col * d_col
+
+    def span(self, centre, reach, size, buckets):
+        """ Buckets along one axis holding the squares within reach of
+        centre, wrapping around the map edge """
+        if 2 * reach + 1 >= size or buckets == 1:
+            return range(buckets)
+        start = (centre - reach) % size
+        end = (centre + reach) % size
+        first = start * buckets // size
+        last = end * buckets // size
+        if start <= end:
+            return range(first, last + 1)
+        if first <= last:
+            # Wrapped all the way round into the bucket it started in
+            return range(buckets)
+        return range(first, buckets) + range(0, last + 1)
+
+    def within(self, loc, radius):
+        """ Returns the locations closer to loc than radius """
+        radius2 = radius * radius
+        reach = int(radius)
+        row, col = loc
+        found = []
+        for bucket_row in self.span(row, reach, self.rows, self.bucket_rows):
+            for bucket_col in self.span(col, reach, self.cols,
+                                        self.bucket_cols):
+                for other in self.buckets.get((bucket_row, bucket_col), ()):
+                    if self.squared_distance(loc, other) < radius2:
+                        found.append(other)
+        return found
+
+    def nearest(self, loc, k=None, radius=None):
+        """ Returns the k locations nearest to loc, or all of them if k is
+        None, nearest first and only ones closer than radius if it is
+        given. Buckets are searched in rings outwards from loc's until
+        nothing further out could be nearer. """
+        centre_row, centre_col = self.bucket(loc)
+        rings = max(self.bucket_rows, self.bucket_cols) // 2 + 1
+        seen = set()
+        found = []
+        for ring in xrange(rings + 1):
+            for d_row in xrange(-ring, ring + 1):
+                for d_col in xrange(-ring, ring + 1):
+                    if max(abs(d_row), abs(d_col)) != ring:
+                        continue
+                    bucket = ((centre_row + d_row) % self.bucket_rows,
+                              (centre_col + d_col) % self.bucket_cols)
+                    if bucket in seen:
+                        continue
+                    seen.add(bucket)
+                    for other in self.buckets.get(bucket, ()):
+                        found.append((self.squared_distance(loc, other),
+                                      other))
+
+            # Anything in the next ring is at least this far away on one
+            # axis
+            beyond = ring * self.width + 1
+            if radius is not None and beyond >= radius:
+                break
+            if k is not None and len(found) >= k:
+                found.sort()
+                if found[k - 1][0] < beyond * beyond:
+                    break
+        found.sort()
+        if radius is not None:
+            radius2 = radius * radius
+            found = [(d, other) for d, other in found if d < radius2]
+        return [other for d, other in found[:k]]
+
+
 class Ants():
     def __init__(self):
         self.cols = None
@@ -60,6 +1300,8 @@ class Ants():
         self.ant_list = {}
         self.dead_list = defaultdict(list)
         self.food_list = []
+        # The turn's ants, hills and food by owner, rebuilt in update()
+        self.views = EntityViews({}, {}, [])
         self.turntime = 0
         self.loadtime = 0
         self.turn_start_time = None
@@ -72,11 +1314,47 @@ class Ants():
         self.attackradius = 0
         self.spawnradius = 0
         
-        self.current_paths = 0
-        self.ant_locations = []
-        self.path_cache = {}        # Dict of {((row, col),(row, col)): [(row,col),(row,col), etc]} i.e. {((start),(end)):[path]}
+        # Flat indices of the squares our ants are on, or have been ordered
+        # onto, this turn. Reset in update(), issue_order() moves them.
+        self.occupied = set()
+        self.path_cache = PathCache()
+        # The bot hands its standing orders to track() every turn
+        self.order_index = OrderIndex()
+        self.path_scheduler = PathScheduler(self)
+        # Built by setup_clusters() or the first hierarchical search
+        self.cluster_map = None
+        # Built by setup_landmarks(), find_path falls back to the Manhattan
+        # distance without it
+        self.landmark_map = None
+        # Built in setup(), tells us which squares can reach each other
+        self.component_map = None
+        # Built in setup(), plans our ants' moves around each other
+        self.reservations = None
+        # The turn's food and enemy hills sorted into buckets, built in
+        # update()
+        self.food_index = None
+        self.enemy_hill_index = None
         
         self.diffusion_map = None
+
+        # Neighbour tables indexed by the flat row * cols + col index of a
+        # square, built once in setup()
+        self.locations = None
+        self.north_of = None
+        self.south_of = None
+        self.east_of = None
+        self.west_of = None
+        self.destinations = None
+        self.adjacency = None
+        # 1 for every water square we know about, by flat index
+        self.water = None
+        # Water squares we saw for the first time in the last update()
+        self.new_water = []
+        # Every row and column number as text, built in setup()
+        self.numbers = None
+        # Every water square we have seen by flat index, in the order we saw
+        # them, path repairs catch up on the ones they missed from it
+        self.water_log = []
         
     def setup(self, data):
         'parse initial input and setup starting game state'
@@ -112,11 +1390,64 @@ class Ants():
         self.diffusion_map = [[0 for col in range(self.cols)]
                     for row in range(self.rows)]
 
+        # Looking the numbers in the turn input up is quicker than int()
+        self.numbers = dict((str(number), number)
+                            for number in xrange(max(self.rows, self.cols)))
+        self.setup_neighbours()
+        self.component_map = ComponentMap(self)
+        self.reservations = ReservationTable(self)
+
+    def setup_neighbours(self):
+        """ Precalculates the neighbours of every square so the hot paths
+        never have to wrap around the map edges themselves """
+        size = self.rows * self.cols
+        self.locations = [(index // self.cols, index % self.cols)
+                          for index in xrange(size)]
+        self.north_of = [((index // self.cols - 1) % self.rows) * self.cols +
+                         index % self.cols for index in xrange(size)]
+        self.south_of = [((index // self.cols + 1) % self.rows) * self.cols +
+                         index % self.cols for index in xrange(size)]
+        self.east_of = [index - index % self.cols + (index + 1) % self.cols
+                        for index in xrange(size)]
+        self.west_of = [index - index % self.cols + (index - 1) % self.cols
+                        for index in xrange(size)]
+
+        locations = self.locations
+        self.destinations = {
+            'n': [locations[index] for index in self.north_of],
+            's': [locations[index] for index in self.south_of],
+            'e': [locations[index] for index in self.east_of],
+            'w': [locations[index] for index in self.west_of]}
+
+        # Neighbours an ant can walk to, water is taken out as we find it
+        self.adjacency = [
+            [self.north_of[index], self.south_of[index],
+             self.east_of[index], self.west_of[index]]
+            for index in xrange(size)]
+        self.water = bytearray(size)
+
+    def remove_water(self, loc):
+        """ Takes a newly seen water square out of the adjacency lists """
+        row, col = loc
+        index = row * self.cols + col
+        for neighbour in self.adjacency[index]:
+            if index in self.adjacency[neighbour]:
+                self.adjacency[neighbour].remove(index)
+        self.adjacency[index] = []
+        self.water[index] = 1
+
     def update(self, data):
-        self.current_paths = 0
-        
-        
         'parse engine input and update the game state'
+        self.start_update()
+        for line in data.split('\n'):
+            self.update_line(line)
+        self.finish_update()
+
+    def start_update(self):
+        """ Starts a new turn, clearing last turn's ants, food and dead ants
+        off the map for update_line() to fill in again """
+        self.path_scheduler.reset()
+
         # start timer
         self.turn_start_time = time.time()
         
@@ -134,37 +1465,79 @@ class Ants():
         for row, col in self.food_list:
             self.map[row][col] = LAND
         self.food_list = []
-        
-        # update map and create new ant and food lists
-        for line in data.split('\n'):
-            line = line.strip().lower()
-            if len(line) > 0:
-                tokens = line.split()
-                if len(tokens) >= 3:
-                    row = int(tokens[1])
-                    col = int(tokens[2])
-                    if tokens[0] == 'w':
-                        self.map[row][col] = WATER
-                    elif tokens[0] == 'f':
-                        self.map[row][col] = FOOD
-                        self.food_list.append((row, col))
-                    else:
-                        owner = int(tokens[3])
-                        if tokens[0] == 'a':
-                            self.map[row][col] = owner
-                            self.ant_list[(row, col)] = owner
-                        elif tokens[0] == 'd':
-                            # food could spawn on a spot where an ant just died
-                            # don't overwrite the space unless it is land
-                            if self.map[row][col] == LAND:
-                                self.map[row][col] = DEAD
-                            # but always add to the dead list
-                            self.dead_list[(row, col)].append(owner)
-                        elif tokens[0] == 'h':
-                            owner = int(tokens[3])
-                            self.hill_list[(row, col)] = owner
+        self.new_water = []
+
+    def update_line(self, line):
+        """ Reads one line of turn input straight into the map and the
+        entity lists. The first letter says what the line is, the ones we
+        don't need are skipped. """
+        numbers = self.numbers
+        kind = line[:1]
+        if kind == 'w':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            map_row = self.map[row]
+            if map_row[col] != WATER:
+                map_row[col] = WATER
+                self.new_water.append((row, col))
+        elif kind == 'a':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            owner = numbers[tokens[3]]
+            self.map[row][col] = owner
+            self.ant_list[(row, col)] = owner
+        elif kind == 'f':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            self.map[row][col] = FOOD
+            self.food_list.append((row, col))
+        elif kind == 'h':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            self.hill_list[(row, col)] = numbers[tokens[3]]
+        elif kind == 'd':
+            tokens = line.split()
+            row = numbers[tokens[1]]
+            col = numbers[tokens[2]]
+            # food could spawn on a spot where an ant just died
+            # don't overwrite the space unless it is land
+            if self.map[row][col] == LAND:
+                self.map[row][col] = DEAD
+            # but always add to the dead list
+            self.dead_list[(row, col)].append(numbers[tokens[3]])
+
+    def finish_update(self):
+        """ Works out the rest of the game state once the last line of the
+        turn has been read """
+        for loc in self.new_water:
+            self.remove_water(loc)
+            self.water_log.append(loc[0] * self.cols + loc[1])
+            self.path_cache.invalidate(loc)
+            self.order_index.add_water(loc)
+            if self.cluster_map is not None:
+                self.cluster_map.add_water(loc)
+            if self.landmark_map is not None:
+                self.landmark_map.add_water(loc)
+            self.component_map.add_water(loc)
+        self.component_map.refresh()
+
+        self.views = EntityViews(self.ant_list, self.hill_list,
+                                 self.food_list)
+
+        # Sort the turn's food and enemy hills for the nearby queries
+        self.food_index = SpatialIndex(self.rows, self.cols, self.food_list)
+        self.enemy_hill_index = SpatialIndex(self.rows, self.cols,
+                                             self.views.enemy_hill_set)
                         
-        self.ant_locations = self.my_ants()
+        self.occupied = set([row * self.cols + col
+                             for row, col in self.my_ants()])
+        if self.landmark_map is not None:
+            self.landmark_map.look(self.my_ants())
+            self.landmark_map.refresh(self.my_ants())
         
     def initialize_diffusion_map(self):
         for row in xrange(self.rows):
@@ -172,9 +1545,9 @@ class Ants():
                 # Set the initial values
                 #self.diffusion_map[row][col] = 0
                 
-                if (row, col) in [loc for loc, owner in self.enemy_hills()]:
+                if (row, col) in self.views.enemy_hill_set:
                     self.diffusion_map[row][col] = 75000
-                if (row, col) in [loc for loc, owner in self.enemy_ants()]:
+                if (row, col) in self.views.enemy_ant_set:
                     self.diffusion_map[row][col] = 10000
                 # Now set up our stuff we know about (food for now!)
                 if self.map[row][col] == FOOD:
@@ -224,17 +1597,17 @@ class Ants():
         for row in xrange(self.rows):
             output = ""
             for col in xrange(self.cols):
-                if (row, col) in self.my_ants():
+                if (row, col) in self.views.my_ant_set:
                     output += "X".rjust(5)
                 elif self.map[row][col]==WATER:
                     output += "W".rjust(5)
                 #elif self.map[row][col]==UNKNOWN:
                 #    output += "U".rjust(5)
-                elif (row, col) in self.food():
+                elif (row, col) in self.views.food_set:
                     output += "F".rjust(5)
-                elif (row, col) in [loc for loc, owner in self.enemy_hills()]:
+                elif (row, col) in self.views.enemy_hill_set:
                     output += "T".rjust(5)
-                elif (row, col) in self.my_hills():
+                elif (row, col) in self.views.my_hill_set:
                     output += "H".rjust(5)
                 else:
                     output += str(self.diffusion_map[row][col]).rjust(5) + " "
@@ -254,9 +1627,9 @@ class Ants():
         src = (row, col)
         dest = self.destination(src, direction)
         self.diffusion_map[row][col] = int(0.9 * self.diffusion_map[row][col])
-        if src in self.ant_locations:
-            self.ant_locations.remove(src)    # Remove where we were
-        self.ant_locations.append(dest)    # Add where we're going!
+        # Remove where we were, add where we're going!
+        self.occupied.discard(row * self.cols + col)
+        self.occupied.add(dest[0] * self.cols + dest[1])
         
         sys.stdout.write('o %s %s %s\n' % (row, col, direction))
         sys.stdout.flush()
@@ -283,46 +1656,43 @@ class Ants():
         return output
     
     def my_hills(self):
-        return [loc for loc, owner in self.hill_list.items()
-                    if owner == MY_ANT]
+        return self.views.my_hills
 
     def enemy_hills(self):
-        return [(loc, owner) for loc, owner in self.hill_list.items()
-                    if owner != MY_ANT]
+        return self.views.enemy_hills
         
     def my_ants(self):
-        'return a list of all my ants'
-        return [(row, col) for (row, col), owner in self.ant_list.items()
-                    if owner == MY_ANT]
+        'return a tuple of all my ants'
+        return self.views.my_ants
 
     def enemy_ants(self):
-        'return a list of all visible enemy ants'
-        return [((row, col), owner)
-                    for (row, col), owner in self.ant_list.items()
-                    if owner != MY_ANT]
+        'return a tuple of all visible enemy ants'
+        return self.views.enemy_ants
 
     def food(self):
-        'return a list of all food locations'
-        return self.food_list[:]
+        'return a tuple of all food locations'
+        return self.views.food
 
     def passable(self, loc):
         row, col = loc
                     
-        if (row, col) in self.ant_locations:
+        if row * self.cols + col in self.occupied:
             return False
         
         return self.map[row][col] != WATER
     
     def unoccupied(self, loc):
-        'true if no ants are at the location'
+        'true if no ants are at the location, or are going to be this turn'
         row, col = loc
-        return self.map[row][col] in (LAND, DEAD)
+        if row * self.cols + col in self.occupied:
+            return False
+        # Our ants that have been ordered away leave their square free
+        return self.map[row][col] in (LAND, DEAD, MY_ANT)
 
     def destination(self, loc, direction):
         'calculate a new location given the direction and wrap correctly'
         row, col = loc
-        d_row, d_col = AIM[direction]
-        return ((row + d_row) % self.rows, (col + d_col) % self.cols)        
+        return self.destinations[direction][row * self.cols + col]
 
     def distance(self, loc1, loc2):
         'calculate the manhatten closest distance between to locations'
@@ -367,112 +1737,333 @@ class Ants():
                 d.append('w')
         return d
     
+    def reachable(self, loc1, loc2):
+        'true if there could be a path between the two locations'
+        return self.component_map.reachable(loc1[0] * self.cols + loc1[1],
+                                            loc2[0] * self.cols + loc2[1])
+
     def neighbors(self, loc):
         n = []
-        directions = ['n', 's', 'e', 'w']
-        for direction in directions:
-            d = self.destination(loc, direction)
-            if self.passable(d):
-                n.append(d)
-        return n     
+        for index in self.adjacency[loc[0] * self.cols + loc[1]]:
+            if index not in self.occupied:
+                n.append(self.locations[index])
+        return n
     
-    def find_path(self, start, end, cache=False):
-        
+    def find_path(self, start, end, cache=False, deadline=None):
+        """ Finds a path from start to end using the A* algorithm, WATER
+        tiles and our own ants are the only barriers. Returns a list of map
+        coordinates (row, col) from start to end, empty if there is none or
+        the search runs past deadline. """
+
         # Check the cache for a path we already know
-        if (start, end) in self.path_cache:
-            logging.info("Yay found a cached path!")
-            return self.path_cache[(start, end)]
-        
-        if self.current_paths > 100:
-            logging.info("Calculated too many paths, skipping the rest for the turn")
-            return []    
-        """ Finds a path from start to end using the A* algorithm, WATER tiles is considered the only barrier. """
-        closed_set = []
-        open_set = [start]
+        path = self.path_cache.get(start, end)
+        if path is not None:
+            return path
+
+        if not self.reachable(start, end):
+            return []
+
+        rows = self.rows
+        cols = self.cols
+        adjacency = self.adjacency
+        blocked = self.occupied
+        source = start[0] * cols + start[1]
+        target = end[0] * cols + end[1]
+        end_row, end_col = end
+        if self.landmark_map is not None:
+            bounds = self.landmark_map.bounds(source, target)
+        else:
+            bounds = []
+
+        def distance(index):
+            row, col = divmod(index, cols)
+            d_row = abs(row - end_row)
+            d_col = abs(col - end_col)
+            h = min(d_row, rows - d_row) + min(d_col, cols - d_col)
+            for table, to_target in bounds:
+                bound = table[index] - to_target
+                if bound < 0:
+                    bound = -bound
+                if bound > h:
+                    h = bound
+            return h
+
+        # The open set is a heap of (f, h, square), squares can be pushed
+        # again with a better g score and the stale entries are skipped when
+        # they come off the heap
+        open_set = [(distance(source), 0, source)]
+        closed_set = set()
         came_from = {}
-        
-        g_score = {}
-        h_score = {}
-        f_score = {}        # f = g + h    
-        
-        g = 0
-        h = self.distance(start, end)
-        f = g + h    
-        g_score[start] = g
-        h_score[start] = h
-        f_score[start] = f
-        
-        iterations = 0
+        g_score = {source: 0}
 
-        def reconstruct_path(from_list, node):
-            """ Reconstructions a path from node, return a list of map coordinates (row, col) to take to get to node """
-            if node in from_list:
-                path = reconstruct_path(from_list, from_list[node])
-                path.append(node)
-                return path
-            else:
-                return [node]
-        
         while open_set:
-            iterations = iterations + 1
-            if iterations > self.viewradius2:
-                self.current_paths = self.current_paths + 1 # Increment timed-out calculations
-                return []
-            # Get the item from open set with the smallest f-score
-            x = open_set[0]
-            for i in open_set:
-                if f_score[i] < f_score[x]:
-                    x = i
-                    
-            if x == end:
-                self.current_paths = self.current_paths + 1 # Increment sucessful calculations
-                path = reconstruct_path(came_from, end)
+            f, h, x = heapq.heappop(open_set)
+            if x in closed_set:
+                continue
+
+            if x == target:
+                # Walk back along came_from to the start
+                path = [end]
+                while x != source:
+                    x = came_from[x]
+                    path.append(self.locations[x])
+                path.reverse()
                 if cache:
-                    self.path_cache[(start,end)] = path
+                    self.path_cache.put(start, end, path)
                 return path
-                    
-            open_set.remove(x)
-            closed_set.append(x)
-            
-            for neighbor in self.neighbors(x):
-                if neighbor in closed_set:
+
+            closed_set.add(x)
+            if len(closed_set) > PATH_MAX_EXPANSIONS:
+                logging.info("Gave up on a path from " + str(start) + " to " +
+                             str(end) + " after " +
+                             str(PATH_MAX_EXPANSIONS) + " squares")
+                return []
+            if deadline is not None and \
+                    not len(closed_set) % PATH_CHECK_EVERY and \
+                    time.time() > deadline:
+                logging.info("Ran out of time for a path from " +
+                             str(start) + " to " + str(end))
+                return []
+
+            tentative_g_score = g_score[x] + 1
+            for neighbor in adjacency[x]:
+                if neighbor in closed_set or neighbor in blocked:
                     continue
-                
-                tentative_is_better = False
-                    
-                tentative_g_score = g_score[x] + 1
-                
-                if neighbor not in open_set:
-                    open_set.append(neighbor)
-                    tentative_is_better = True
-                elif tentative_g_score < g_score[neighbor]:
-                    tentative_is_better = True
-                else:
-                    tentative_is_better = False
-                    
-                if tentative_is_better == True:
+                if tentative_g_score < g_score.get(neighbor, tentative_g_score + 1):
                     came_from[neighbor] = x
                     g_score[neighbor] = tentative_g_score
-                    h = self.distance(neighbor, end)
-                    h_score[neighbor] = h
-                    f_score[neighbor] = tentative_g_score + h
-                    
-                    
-        # No path!?
-        logging.info("THIS IS BAD, SHOULD NEVER HAPPEN!")
-        return []            
+                    h = distance(neighbor)
+                    heapq.heappush(open_set,
+                                   (tentative_g_score + h, h, neighbor))
+
+        # Every square we can reach has been searched
+        return []
+
+    def find_path_jps(self, start, end, deadline=None):
+        """ Finds the same shortest paths as find_path with Jump Point
+        Search, which skips over the squares in open ground that A* would
+        expand one at a time. Only the jump points go in the open set, the
+        path between them is filled back in one step at a time. """
+        if not self.reachable(start, end):
+            return []
+
+        rows = self.rows
+        cols = self.cols
+        steps = {'n': self.north_of, 's': self.south_of,
+                 'e': self.east_of, 'w': self.west_of}
+        north = self.north_of
+        south = self.south_of
+        east = self.east_of
+        west = self.west_of
+        # Water and our own ants are the barriers, like in find_path
+        blocked = bytearray(self.water)
+        for index in self.occupied:
+            blocked[index] = 1
+        source = start[0] * cols + start[1]
+        target = end[0] * cols + end[1]
+        end_row, end_col = end
+
+        def distance(index):
+            row, col = divmod(index, cols)
+            d_row = abs(row - end_row)
+            d_col = abs(col - end_col)
+            return min(d_row, rows - d_row) + min(d_col, cols - d_col)
+
+        def jump_across(x, forward, behind):
+            """ True if walking east or west from x finds a jump point """
+            for step in xrange(cols):
+                if blocked[x]:
+                    return False
+                if x == target:
+                    return True
+                if (not blocked[north[x]] and blocked[north[behind[x]]]) or \
+                        (not blocked[south[x]] and blocked[south[behind[x]]]):
+                    return True
+                x = forward[x]
+            return False
+
+        def jump(x, direction):
+            """ Walks from x in direction until the next jump point, returns
+            it and how many steps away it is or (None, 0) """
+            forward = steps[direction]
+            behind = steps[BEHIND[direction]]
+            limit = cols if direction in 'ew' else rows
+            for step in xrange(1, limit + 1):
+                if blocked[x]:
+                    return None, 0
+                if x == target:
+                    return x, step
+                if direction in 'ew':
+                    if (not blocked[north[x]] and blocked[north[behind[x]]]) or \
+                            (not blocked[south[x]] and blocked[south[behind[x]]]):
+                        return x, step
+                else:
+                    if (not blocked[east[x]] and blocked[east[behind[x]]]) or \
+                            (not blocked[west[x]] and blocked[west[behind[x]]]):
+                        return x, step
+                    # Moving north or south we have to stop anywhere a jump
+                    # east or west would find something
+                    if jump_across(east[x], east, west) or \
+                            jump_across(west[x], west, east):
+                        return x, step
+                x = forward[x]
+            return None, 0
+
+        # Turning back the way we came never helps, so each jump point only
+        # carries on ahead or turns to either side
+        turns = {'n': 'new', 's': 'sew', 'e': 'ens', 'w': 'wns'}
+
+        open_set = [(distance(source), 0, source)]
+        closed_set = set()
+        g_score = {source: 0}
+        came_from = {source: (None, None, 0)}
+        while open_set:
+            f, h, x = heapq.heappop(open_set)
+            if x in closed_set:
+                continue
+
+            if x == target:
+                # Fill in the squares between the jump points
+                path = [end]
+                while x != source:
+                    previous, direction, length = came_from[x]
+                    back = steps[BEHIND[direction]]
+                    for step in xrange(length):
+                        x = back[x]
+                        path.append(self.locations[x])
+                path.reverse()
+                return path
+
+            closed_set.add(x)
+            if len(closed_set) > PATH_MAX_EXPANSIONS:
+                logging.info("Gave up on a path from " + str(start) + " to " +
+                             str(end) + " after " +
+                             str(PATH_MAX_EXPANSIONS) + " squares")
+                return []
+            if deadline is not None and \
+                    not len(closed_set) % PATH_CHECK_EVERY and \
+                    time.time() > deadline:
+                logging.info("Ran out of time for a path from " +
+                             str(start) + " to " + str(end))
+                return []
+
+            direction = came_from[x][1]
+            for next_direction in turns.get(direction, 'nsew'):
+                point, length = jump(steps[next_direction][x], next_direction)
+                if point is None or point in closed_set:
+                    continue
+                tentative_g_score = g_score[x] + length
+                if tentative_g_score < g_score.get(point, tentative_g_score + 1):
+                    g_score[point] = tentative_g_score
+                    came_from[point] = (x, next_direction, length)
+                    h = distance(point)
+                    heapq.heappush(open_set,
+                                   (tentative_g_score + h, h, point))
+
+        # Every square we can reach has been searched
+        return []
+
+    def setup_clusters(self):
+        """ Builds the cluster graph for hierarchical searches, call this
+        from do_setup() so it isn't built in the middle of a turn """
+        if self.cluster_map is None:
+            self.cluster_map = ClusterMap(self)
+
+    def setup_landmarks(self):
+        """ Starts keeping track of what we have seen so landmarks for the
+        find_path heuristic can be picked once we know enough of the map,
+        call it from do_setup() """
+        if self.landmark_map is None:
+            self.landmark_map = LandmarkMap(self)
+
+    def find_path_hpa(self, start, end, deadline=None):
+        """ Finds a path from start towards end with a hierarchical search
+        over the cluster graph. Long paths only run as far as the first
+        square in the next cluster on the way, search again from the end of
+        it. Paths shorter than two clusters are found with find_path. """
+        if not self.reachable(start, end):
+            return []
+
+        if self.distance(start, end) < 2 * CLUSTER_SIZE:
+            return self.find_path(start, end, cache=True, deadline=deadline)
 
-    def find_first_path(self, location, destinations):
+        self.setup_clusters()
+        return self.cluster_map.find_path(start, end, deadline)
+
+    def find_first_path(self, location, destinations, search='astar',
+                        deadline=None):
+        """ Returns (destination, path) for the first of destinations we
+        can find a path to, search is 'astar' for find_path, 'hpa' for
+        find_path_hpa or 'jps' for find_path_jps. Gives up once the time
+        is past deadline. """
         random.shuffle(destinations)    # Add some randomness to our lives!
         path = None
         dest = None
         for d in destinations:
-            path = self.find_path(location, d)
+            if deadline is not None and time.time() > deadline:
+                break
+            if search == 'hpa':
+                path = self.find_path_hpa(location, d, deadline)
+            elif search == 'jps':
+                path = self.find_path_jps(location, d, deadline)
+            else:
+                path = self.find_path(location, d, cache=True,
+                                      deadline=deadline)
             if path:
                 return (d, path)
         
         return (None, None)
 
+    def assign_food(self, ants, food_list, max_distance=None):
+        """ Sends each food to its nearest reachable ant in ants with one
+        breadth first search spreading out from all the food at once, so
+        the closest food and ant pairs on the whole map are matched first.
+        Our ants block the search like they do in find_path. Returns a list
+        of (ant, food, path) with path running from the ant to the food. """
+        cols = self.cols
+        adjacency = self.adjacency
+        locations = self.locations
+        blocked = self.occupied
+        hungry = set([row * cols + col for row, col in ants])
+
+        # Each food's search keeps its own came_from so the searches can
+        # cross each other, and stops as soon as the food has its ant
+        came_from = {}
+        queue = deque()
+        for row, col in food_list:
+            index = row * cols + col
+            if index not in came_from:
+                came_from[index] = {index: None}
+                queue.append((index, index, 0))
+
+        assigned = set()
+        assignments = []
+        while queue and hungry and len(assigned) < len(came_from):
+            x, food, distance = queue.popleft()
+            if food in assigned:
+                continue
+
+            if x in hungry:
+                hungry.remove(x)
+                assigned.add(food)
+                parents = came_from[food]
+                path = [locations[x]]
+                while x != food:
+                    x = parents[x]
+                    path.append(locations[x])
+                assignments.append((path[0], path[-1], path))
+                continue
+
+            if x in blocked or distance == max_distance:
+                continue
+            parents = came_from[food]
+            for neighbor in adjacency[x]:
+                if neighbor not in parents:
+                    parents[neighbor] = x
+                    queue.append((neighbor, food, distance + 1))
+
+        return assignments
+
     def closest_unknown(self, loc, exclude=None):
         lr, lc = loc
 
@@ -492,11 +2083,10 @@ class Ants():
         
 
     def nearby_enemy_hills(self, loc):
-        hills = []
-        for hill_loc, owner in self.enemy_hills():
-            if self.real_distance(loc, hill_loc) < self.viewradius:
-                hills.append(hill_loc)
-        return hills
+        return [hill_loc for hill_loc
+                    in self.enemy_hill_index.nearest(loc,
+                                                     radius=self.viewradius)
+                    if self.reachable(loc, hill_loc)]
         
     def nearby_location(self, loc, radius=None):
         """ Find a nearby non-water location """
@@ -541,7 +2131,8 @@ class Ants():
                 if col > self.cols-1:
                     col -= self.cols
                     
-                if self.map[row][col] == UNKNOWN:
+                if self.map[row][col] == UNKNOWN and \
+                        self.reachable(loc, (row, col)):
                     locations.append((row, col))
         random.shuffle(locations)
         return locations[:5]
@@ -612,22 +2203,17 @@ class Ants():
     def closest_food(self, loc, exclude=None):
         if exclude==None:
             exclude = [] 
-        mindist = sys.maxint
-        closest = None
-        for row in xrange(self.rows):
-            for col in xrange(self.cols):
-                if self.map[row][col] == FOOD:
-                        mindist = d
-                        closest = (row, col)
-        #logging.info("Closest: ")
-        return closest   
+        for food_loc in self.food_index.nearest(loc):
+            if food_loc not in exclude:
+                return food_loc
+        return None
         
     def nearby_food(self, location, food_list):
-        results = []
-        for food_loc in food_list:
-            dist = self.real_distance(location, food_loc)
-            if dist < self.viewradius:
-                results.append(food_loc)
+        food_list = set(food_list)
+        results = [food_loc for food_loc
+                       in self.food_index.within(location, self.viewradius)
+                       if food_loc in food_list and
+                           self.reachable(location, food_loc)]
                 
         random.shuffle(results)
         return results[:5]
@@ -674,31 +2260,45 @@ class Ants():
     def run(bot):
         'parse input, update game state and call the bot classes do_turn method'
         ants = Ants()
-        map_data = ''
+        # Settings are gathered up for setup(), turn lines go straight into
+        # the game state as they come in
+        setup_data = []
+        in_turn = False
         while(True):
             try:
-                current_line = sys.stdin.readline().rstrip('\r\n') # string new line char
-                if current_line.lower() == 'ready':
-                    ants.setup(map_data)
-                    bot.do_setup(ants)
-                    ants.finish_turn()
-                    map_data = ''
-                elif current_line.lower() == 'go':
-                    ants.update(map_data)
-                    # call the do_turn method of the class passed in
+                current_line = sys.stdin.readline()
+                if not current_line:
+                    # The engine has gone
+                    break
+                kind = current_line[:1]
+                if setup_data is not None:
+                    if current_line.rstrip('\r\n').lower() == 'ready':
+                        ants.setup(''.join(setup_data))
+                        bot.do_setup(ants)
+                        ants.finish_turn()
+                        setup_data = None
+                    else:
+                        setup_data.append(current_line)
+                    continue
+
+                if not in_turn:
+                    ants.start_update()
+                    in_turn = True
+                if kind == 'g':
+                    # The turn is over and the go line gets written even if
+                    # working out the game state or the orders fails
+                    in_turn = False
                     try:
+                        ants.finish_update()
+                        # call the do_turn method of the class passed in
                         bot.do_turn(ants)
                     except:
                         logging.info("OMG CAUGHT AN EXCEPTION")
-                        import traceback
                         formatted_lines = traceback.format_exc()
                         logging.info(str(formatted_lines))
-                    
-                    
                     ants.finish_turn()
-                    map_data = ''
                 else:
-                    map_data += current_line + '\n'
+                    ants.update_line(current_line)
             except EOFError:
                 break
             except KeyboardInterrupt: